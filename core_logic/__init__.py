@@ -1,4 +1,5 @@
-from .leaky_bucket import LeakyBucket
+from .leaky_bucket import LeakyBucket, TokenBucket
 from .database import Database
+from .async_database import AsyncDatabase
 
-__all__ = ['LeakyBucket', 'Database']
\ No newline at end of file
+__all__ = ['LeakyBucket', 'TokenBucket', 'Database', 'AsyncDatabase']
\ No newline at end of file
@@ -0,0 +1,70 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .database import Database
+from .write_batcher import WriteBatcher
+
+
+class AsyncDatabase:
+    """
+    Awaitable facade over Database for use from the async server.
+
+    Every public Database method is exposed under the same name as a
+    coroutine that runs the blocking SQLite call on a dedicated thread
+    pool, so slow queries and busy_timeout waits never stall the event loop.
+    High-frequency chat writes are routed through a WriteBatcher instead.
+    """
+
+    # Writes coalesced into group commits
+    BATCHED_METHODS = frozenset({
+        'save_message_with_id',
+        'add_reaction',
+        'update_message',
+        'delete_message',
+        'mark_message_read',
+    })
+
+    def __init__(self, database: Database, max_workers: int = None, batch_writes: bool = True):
+        """
+        :param database: The synchronous Database to delegate to.
+        :param max_workers: Size of the DB thread pool (defaults to readers + 1 writer).
+        :param batch_writes: Group-commit chat writes through a WriteBatcher.
+        """
+        self.database = database
+        if max_workers is None:
+            max_workers = database._pool.max_readers + 1
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._batcher = WriteBatcher(database) if batch_writes else None
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking callable on the DB thread pool and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def run_batched(self, func, *args, **kwargs):
+        """Queue a write for the next group commit and await its result."""
+        if self._batcher is None:
+            return await self.run(func, *args, **kwargs)
+        return await asyncio.wrap_future(self._batcher.submit(func, *args, **kwargs))
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.database, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        runner = self.run_batched if name in self.BATCHED_METHODS else self.run
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await runner(attr, *args, **kwargs)
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, wrapper)
+        return wrapper
+
+    def close(self):
+        """Flush pending writes and in-flight queries, then close the database."""
+        if self._batcher is not None:
+            self._batcher.close()
+        self._executor.shutdown(wait=True)
+        self.database.close()
@@ -0,0 +1,214 @@
+import asyncio
+from typing import Callable, List
+from urllib.parse import urlparse
+from .resp import encode_command, read_reply, open_connection
+
+
+class Broker:
+    """
+    Pub/sub backplane shared by every worker process.
+
+    Each ConnectionManager publishes its outgoing events to the broker and
+    delivers whatever the broker hands back to its own local connections, so
+    a user connected to one worker still receives events raised on another.
+    Publishers also receive their own messages.
+    """
+
+    def __init__(self):
+        self._handlers: List[Callable[[str], None]] = []
+        self._lost_handlers: List[Callable[[], None]] = []
+
+    def subscribe(self, handler: Callable[[str], None]):
+        """Register a callback invoked with every published payload."""
+        self._handlers.append(handler)
+
+    def on_lost(self, handler: Callable[[], None]):
+        """
+        Register a callback invoked when payloads may have been lost: a publish
+        failed, or the subscription was down for a while.
+        """
+        self._lost_handlers.append(handler)
+
+    def _lost(self):
+        for handler in list(self._lost_handlers):
+            try:
+                handler()
+            except Exception as e:
+                print(f"Broker lost-events handler error: {e}")
+
+    def _dispatch(self, payload: str):
+        for handler in list(self._handlers):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"Broker handler error: {e}")
+
+    async def start(self):
+        """Connect to the backplane."""
+
+    async def publish(self, payload: str):
+        """Send a payload to every subscriber, including this process."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Disconnect from the backplane."""
+
+
+class InProcessBroker(Broker):
+    """Broker for a single worker: payloads are dispatched directly."""
+
+    async def publish(self, payload: str):
+        self._dispatch(payload)
+
+
+class RedisBroker(Broker):
+    """
+    Broker speaking the Redis protocol (RESP) over plain asyncio streams.
+
+    Uses one connection for SUBSCRIBE and another for PUBLISH. Works with
+    Redis, Valkey, KeyDB or any other server implementing PUBLISH/SUBSCRIBE.
+
+    A lost subscription is re-established in the background with exponential
+    backoff. A lost publish connection is reopened on the next publish; while
+    the server stays unreachable, events are logged and dropped rather than
+    blocking the sender. Events published during an outage are not replayed,
+    so state derived from them (such as presence) must resync by itself.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379", channel: str = "mkchat",
+                 retry_delay: float = 0.1, max_retry_delay: float = 5.0):
+        """
+        :param url: redis://[:password@]host[:port] of the server.
+        :param channel: Pub/sub channel shared by all workers.
+        :param retry_delay: Seconds before the first reconnect attempt.
+        :param max_retry_delay: Cap on the doubling delay between attempts.
+        """
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._pub_reader: asyncio.StreamReader = None
+        self._pub_writer: asyncio.StreamWriter = None
+        self._pub_lock: asyncio.Lock = None
+        self._pub_delay = retry_delay
+        self._pub_retry_at = 0.0
+        self._pub_task: asyncio.Task = None
+        self._sub_writer: asyncio.StreamWriter = None
+        self._sub_task: asyncio.Task = None
+
+    async def start(self):
+        # Fail fast if the server is unreachable at startup
+        self._pub_lock = asyncio.Lock()
+        await self._connect_publisher()
+        reader = await self._subscribe()
+        self._sub_task = asyncio.create_task(self._listen(reader))
+
+    async def _subscribe(self) -> asyncio.StreamReader:
+        reader, writer = await open_connection(self.url)
+        try:
+            writer.write(encode_command("SUBSCRIBE", self.channel))
+            await writer.drain()
+            await read_reply(reader)  # Subscription confirmation
+        except BaseException:
+            writer.close()
+            raise
+        self._sub_writer = writer
+        return reader
+
+    async def _listen(self, reader: asyncio.StreamReader):
+        """Dispatch published messages, resubscribing with backoff whenever the connection drops."""
+        delay = self.retry_delay
+        while True:
+            try:
+                if reader is None:
+                    reader = await self._subscribe()
+                    print(f"Broker resubscribed to {self.channel}")
+                    delay = self.retry_delay
+                    self._lost()  # Nothing published while we were away is replayed
+                while True:
+                    reply = await read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._dispatch(reply[2].decode())
+            except (OSError, asyncio.IncompleteReadError) as e:
+                print(f"Broker subscription lost ({e or type(e).__name__}), retrying in {delay:.1f}s")
+            reader = None
+            if self._sub_writer is not None:
+                self._sub_writer.close()
+                self._sub_writer = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    async def _connect_publisher(self):
+        self._pub_reader, self._pub_writer = await open_connection(self.url)
+        self._pub_task = asyncio.create_task(self._drain_publish_replies(self._pub_reader))
+
+    def _drop_publisher(self):
+        if self._pub_task is not None and self._pub_task is not asyncio.current_task():
+            self._pub_task.cancel()
+        if self._pub_writer is not None:
+            self._pub_writer.close()
+        self._pub_reader = self._pub_writer = self._pub_task = None
+
+    async def _drain_publish_replies(self, reader: asyncio.StreamReader):
+        """Consume PUBLISH replies so publishing never waits on a round trip."""
+        try:
+            while True:
+                await read_reply(reader)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            print(f"Broker publish connection lost ({e or type(e).__name__})")
+            if self._pub_reader is reader:
+                self._drop_publisher()
+                self._lost()  # The last writes may never have reached the server
+
+    async def _publisher(self) -> asyncio.StreamWriter:
+        """The publish connection, reopened if it was lost and the backoff has passed."""
+        if self._pub_writer is not None:
+            return self._pub_writer
+        async with self._pub_lock:
+            if self._pub_writer is None:
+                loop = asyncio.get_running_loop()
+                if loop.time() < self._pub_retry_at:
+                    raise ConnectionError("reconnect backing off")
+                try:
+                    await self._connect_publisher()
+                except OSError:
+                    self._pub_retry_at = loop.time() + self._pub_delay
+                    self._pub_delay = min(self._pub_delay * 2, self.max_retry_delay)
+                    raise
+                self._pub_delay = self.retry_delay
+            return self._pub_writer
+
+    async def publish(self, payload: str):
+        command = encode_command("PUBLISH", self.channel, payload.encode())
+        error = None
+        # A connection found dead on write is retried once straight away
+        for _ in range(2):
+            try:
+                writer = await self._publisher()
+                writer.write(command)
+                await writer.drain()
+                return
+            except OSError as e:
+                error = error or e
+                self._drop_publisher()
+        print(f"Broker publish failed ({error or type(error).__name__}), event dropped")
+        self._lost()
+
+    async def close(self):
+        for task in (self._sub_task, self._pub_task):
+            if task is not None:
+                task.cancel()
+        for writer in (self._pub_writer, self._sub_writer):
+            if writer is not None:
+                writer.close()
+
+
+def create_broker(url: str = None) -> Broker:
+    """Builds a broker from a URL; no URL means a single in-process worker."""
+    if not url:
+        return InProcessBroker()
+    scheme = urlparse(url).scheme
+    if scheme == "redis":
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported broker URL: {url}")
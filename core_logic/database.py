@@ -1,335 +1,613 @@
 ﻿import sqlite3
-import hashlib
-from typing import List, Dict
-from datetime import datetime
+import queue
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Optional
+from datetime import date, datetime, timedelta
+
+
+class ConnectionPool:
+    """
+    Long-lived SQLite connections shared by a Database instance.
+
+    SQLite allows a single writer at a time, so all writes go through one
+    dedicated connection guarded by a lock. Reads are served from a bounded
+    set of connections which, thanks to WAL mode, never block the writer.
+    Every connection keeps its own prepared statement cache.
+    """
+
+    def __init__(self, db_path: str, max_readers: int = 4, cached_statements: int = 256):
+        """
+        :param db_path: Path to the SQLite database file.
+        :param max_readers: Maximum number of reader connections kept open.
+        :param cached_statements: Prepared statements cached per connection.
+        """
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.cached_statements = cached_statements
+
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")  # Write-Ahead Logging for better concurrency
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with timeout and optimized settings."""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=30.0,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.execute("PRAGMA busy_timeout=30000")  # 30 second timeout
+        return conn
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        """Take an idle reader, opening a new one while under the limit."""
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._reader_lock:
+            if self._reader_count < self.max_readers:
+                self._reader_count += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._reader_count -= 1
+                    raise
+
+        # Pool exhausted, wait for a reader to be handed back
+        return self._readers.get()
+
+    @contextmanager
+    def reader(self):
+        """Borrow a reader connection for the duration of the block."""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """
+        Hold the writer connection for the duration of the block.
+        Commits on success and rolls back if the block raises.
+        Nested use from the same thread joins the outer transaction.
+        """
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+        with self._writer_lock:
+            self._writer_depth += 1
+            try:
+                yield self._writer
+            except BaseException:
+                if self._writer_depth == 1:
+                    self._writer.rollback()
+                raise
+            else:
+                if self._writer_depth == 1:
+                    self._writer.commit()
+            finally:
+                self._writer_depth -= 1
+
+    def close(self):
+        """Close the writer and every idle reader connection."""
+        self._closed = True
+        with self._writer_lock:
+            self._writer.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
 
 
 class Database:
     """Database handler for chat application using SQLite."""
-    
-    def __init__(self, db_path: str = "chat_history.db"):
+
+    # Schema migrations, applied in order and tracked with PRAGMA user_version.
+    # Append new steps to the end; never edit or reorder shipped ones.
+    MIGRATIONS = [
+        # 1: Indexes for history, per-user stats and admin queries
+        [
+            "CREATE INDEX IF NOT EXISTS idx_messages_recipient_deleted_timestamp ON messages(recipient, deleted, timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_sender_recipient_timestamp ON messages(sender, recipient, timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)",
+        ],
+        # 2: Full-text search index over live (non-deleted) messages
+        [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages', content_rowid='id')",
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            WHEN new.deleted = 0 BEGIN
+                INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, deleted ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, message)
+                    SELECT 'delete', old.id, old.message WHERE old.deleted = 0;
+                INSERT INTO messages_fts(rowid, message)
+                    SELECT new.id, new.message WHERE new.deleted = 0;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            WHEN old.deleted = 0 BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            END
+            """,
+            "INSERT INTO messages_fts(rowid, message) SELECT id, message FROM messages WHERE deleted = 0",
+        ],
+        # 3: Order conversation indexes by id (the implicit rowid suffix) for keyset pagination
+        [
+            "DROP INDEX IF EXISTS idx_messages_recipient_deleted_timestamp",
+            "DROP INDEX IF EXISTS idx_messages_sender_recipient_timestamp",
+            "CREATE INDEX IF NOT EXISTS idx_messages_recipient_deleted ON messages(recipient, deleted)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_sender_recipient_deleted ON messages(sender, recipient, deleted)",
+        ],
+        # 4: Reference counting of uploaded files by the messages that share them
+        [
+            "CREATE INDEX IF NOT EXISTS idx_messages_file_url ON messages(file_url, deleted) WHERE file_url IS NOT NULL",
+        ],
+        # 5: Thumbnail and blur placeholder generated for image attachments
+        [
+            "ALTER TABLE messages ADD COLUMN thumbnail_url TEXT DEFAULT NULL",
+            "ALTER TABLE messages ADD COLUMN placeholder TEXT DEFAULT NULL",
+        ],
+        # 6: Per-user stats kept up to date by triggers, indexed for each admin sort order
+        [
+            """
+            CREATE TABLE IF NOT EXISTS user_stats (
+                username TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                last_active TEXT DEFAULT NULL,
+                bytes_uploaded INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            INSERT OR IGNORE INTO user_stats (username, message_count, last_active)
+            SELECT u.username, COUNT(m.id), MAX(m.timestamp)
+            FROM users u
+            LEFT JOIN messages m ON u.username = m.sender
+            GROUP BY u.username
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS user_stats_user_insert AFTER INSERT ON users BEGIN
+                INSERT OR IGNORE INTO user_stats (username) VALUES (new.username);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS user_stats_message_insert AFTER INSERT ON messages BEGIN
+                UPDATE user_stats
+                SET message_count = message_count + 1,
+                    last_active = MAX(COALESCE(last_active, ''), new.timestamp)
+                WHERE username = new.sender;
+            END
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_user_stats_message_count ON user_stats(message_count, username)",
+            "CREATE INDEX IF NOT EXISTS idx_user_stats_last_active ON user_stats(last_active, username)",
+            "CREATE INDEX IF NOT EXISTS idx_user_stats_bytes_uploaded ON user_stats(bytes_uploaded, username)",
+            "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at, username)",
+        ],
+    ]
+
+    # Sort orders offered by get_all_users_with_stats -> (table, column) the page is cut from
+    USER_SORT_COLUMNS = {
+        'username': ('users', 'username'),
+        'created_at': ('users', 'created_at'),
+        'message_count': ('user_stats', 'message_count'),
+        'last_active': ('user_stats', 'last_active'),
+        'bytes_uploaded': ('user_stats', 'bytes_uploaded'),
+    }
+
+    def __init__(self, db_path: str = "chat_history.db", max_readers: int = 4):
         self.db_path = db_path
+        self._pool = ConnectionPool(db_path, max_readers=max_readers)
         self._init_database()
+        self._migrate()
 
-    def _get_connection(self):
-        """Get database connection with timeout and optimized settings."""
-        conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
-        conn.execute("PRAGMA journal_mode=WAL")  # Write-Ahead Logging for better concurrency
-        conn.execute("PRAGMA busy_timeout=30000")  # 30 second timeout
-        return conn
+    def _read(self):
+        """Borrow a pooled reader connection."""
+        return self._pool.reader()
+
+    def _write(self):
+        """Borrow the pooled writer connection inside a transaction."""
+        return self._pool.writer()
+
+    def close(self):
+        """Close all pooled connections."""
+        self._pool.close()
 
     def _init_database(self):
         """Initialize database tables."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                avatar_color TEXT DEFAULT '#6366f1',
-                status TEXT DEFAULT 'online',
-                status_message TEXT DEFAULT ''
-            )
-        """)
-        
-        # Messages table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                recipient TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                edited INTEGER DEFAULT 0,
-                deleted INTEGER DEFAULT 0,
-                reply_to INTEGER DEFAULT NULL,
-                file_url TEXT DEFAULT NULL,
-                file_type TEXT DEFAULT NULL,
-                FOREIGN KEY (sender) REFERENCES users(username),
-                FOREIGN KEY (reply_to) REFERENCES messages(id)
-            )
-        """)
-        
-        # Reactions table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS reactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                emoji TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                FOREIGN KEY (message_id) REFERENCES messages(id),
-                FOREIGN KEY (username) REFERENCES users(username),
-                UNIQUE(message_id, username, emoji)
-            )
-        """)
-        
-        # Read receipts table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS read_receipts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                read_at TEXT NOT NULL,
-                FOREIGN KEY (message_id) REFERENCES messages(id),
-                FOREIGN KEY (username) REFERENCES users(username),
-                UNIQUE(message_id, username)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        with self._write() as conn:
+            cursor = conn.cursor()
+
+            # Users table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    avatar_color TEXT DEFAULT '#6366f1',
+                    status TEXT DEFAULT 'online',
+                    status_message TEXT DEFAULT ''
+                )
+            """)
+
+            # Messages table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT NOT NULL,
+                    recipient TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    edited INTEGER DEFAULT 0,
+                    deleted INTEGER DEFAULT 0,
+                    reply_to INTEGER DEFAULT NULL,
+                    file_url TEXT DEFAULT NULL,
+                    file_type TEXT DEFAULT NULL,
+                    FOREIGN KEY (sender) REFERENCES users(username),
+                    FOREIGN KEY (reply_to) REFERENCES messages(id)
+                )
+            """)
+
+            # Reactions table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS reactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    emoji TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    FOREIGN KEY (message_id) REFERENCES messages(id),
+                    FOREIGN KEY (username) REFERENCES users(username),
+                    UNIQUE(message_id, username, emoji)
+                )
+            """)
+
+            # Read receipts table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS read_receipts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    read_at TEXT NOT NULL,
+                    FOREIGN KEY (message_id) REFERENCES messages(id),
+                    FOREIGN KEY (username) REFERENCES users(username),
+                    UNIQUE(message_id, username)
+                )
+            """)
 
-    def _hash_password(self, password: str) -> str:
-        """Hash password using SHA-256."""
-        return hashlib.sha256(password.encode()).hexdigest()
+    def _migrate(self):
+        """
+        Apply any schema migrations newer than the database's user_version.
+        Several processes may start on the same database at once, so each step
+        takes the write lock first and re-reads the version under it, and a
+        step another process applied meanwhile is skipped.
+        """
+        with self._read() as conn:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
 
-    def create_user(self, username: str, password: str) -> bool:
-        """Create a new user."""
+        for version in range(current + 1, len(self.MIGRATIONS) + 1):
+            with self._write() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+                for statement in self.MIGRATIONS[version - 1]:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+
+    def create_user(self, username: str, password_hash: str) -> bool:
+        """Create a new user (hash the password with PasswordHasher first)."""
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            
-            password_hash = self._hash_password(password)
-            created_at = datetime.now().isoformat()
-            
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
-                (username, password_hash, created_at)
-            )
-            
-            conn.commit()
-            conn.close()
+            with self._write() as conn:
+                cursor = conn.cursor()
+
+                created_at = datetime.now().isoformat()
+
+                cursor.execute(
+                    "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                    (username, password_hash, created_at)
+                )
             return True
         except sqlite3.IntegrityError:
             return False
 
-    def verify_user(self, username: str, password: str) -> bool:
-        """Verify user credentials."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        password_hash = self._hash_password(password)
-        
-        cursor.execute(
-            "SELECT password_hash FROM users WHERE username = ?",
-            (username,)
-        )
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result and result[0] == password_hash:
-            return True
-        return False
+    def get_password_hash(self, username: str) -> Optional[str]:
+        """Get a user's stored password hash (None if there is no such user)."""
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT password_hash FROM users WHERE username = ?",
+                (username,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def update_password_hash(self, username: str, old_hash: str, new_hash: str) -> bool:
+        """Replace a user's password hash, unless it changed since old_hash was read."""
+        with self._write() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?",
+                (new_hash, username, old_hash)
+            )
+            return cursor.rowcount > 0
 
     def user_exists(self, username: str) -> bool:
         """Check if user exists."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT username FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        
-        conn.close()
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT username FROM users WHERE username = ?", (username,))
+            result = cursor.fetchone()
+
         return result is not None
 
     def get_all_users(self) -> List[str]:
         """Get all registered usernames."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT username FROM users ORDER BY username")
-        users = [row[0] for row in cursor.fetchall()]
-        
-        conn.close()
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT username FROM users ORDER BY username")
+            users = [row[0] for row in cursor.fetchall()]
+
         return users
 
     def save_message(self, sender: str, recipient: str, message: str, timestamp: str):
         """Save a message to database."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO messages (sender, recipient, message, timestamp) VALUES (?, ?, ?, ?)",
-            (sender, recipient, message, timestamp)
-        )
-        
-        conn.commit()
-        conn.close()
+        with self._write() as conn:
+            conn.execute(
+                "INSERT INTO messages (sender, recipient, message, timestamp) VALUES (?, ?, ?, ?)",
+                (sender, recipient, message, timestamp)
+            )
 
     def get_group_messages(self, limit: int = 100) -> List[Dict]:
         """Get group chat messages."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            """
-            SELECT sender, message, timestamp
-            FROM messages
-            WHERE recipient = 'GROUP'
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
-            (limit,)
-        )
-        
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT sender, message, timestamp
+                FROM messages
+                WHERE recipient = 'GROUP'
+                ORDER BY timestamp DESC
+                LIMIT ?
+                """,
+                (limit,)
+            )
+            rows = cursor.fetchall()
+
         messages = []
-        for row in cursor.fetchall():
+        for row in rows:
             messages.append({
                 "sender": row[0],
                 "message": row[1],
                 "timestamp": row[2]
             })
-        
-        conn.close()
+
         return list(reversed(messages))
 
     def get_private_messages(self, user1: str, user2: str, limit: int = 100) -> List[Dict]:
         """Get private messages between two users."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            """
-            SELECT sender, message, timestamp
-            FROM messages
-            WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
-            (user1, user2, user2, user1, limit)
-        )
-        
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT sender, message, timestamp
+                FROM messages
+                WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
+                ORDER BY timestamp DESC
+                LIMIT ?
+                """,
+                (user1, user2, user2, user1, limit)
+            )
+            rows = cursor.fetchall()
+
         messages = []
-        for row in cursor.fetchall():
+        for row in rows:
             messages.append({
                 "sender": row[0],
                 "message": row[1],
                 "timestamp": row[2]
             })
-        
-        conn.close()
+
         return list(reversed(messages))
 
     def get_total_users(self) -> int:
         """Get total number of registered users."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        with self._read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
 
     def get_total_messages(self) -> int:
         """Get total number of messages."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        with self._read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
 
     def get_messages_today(self) -> int:
         """Get number of messages sent today."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        today = datetime.now().date().isoformat()
-        cursor.execute(
-            "SELECT COUNT(*) FROM messages WHERE DATE(timestamp) = ?",
-            (today,)
-        )
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        today = datetime.now().date()
+        tomorrow = today + timedelta(days=1)
+        with self._read() as conn:
+            # Range on the raw ISO timestamp so the timestamp index is used
+            return conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE timestamp >= ? AND timestamp < ?",
+                (today.isoformat(), tomorrow.isoformat())
+            ).fetchone()[0]
 
     def get_group_message_count(self) -> int:
         """Get total number of group messages."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE recipient = 'GROUP'")
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
-
-    def get_all_users_with_stats(self) -> List[Dict]:
-        """Get all users with their message counts."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                u.username,
-                u.created_at,
-                COUNT(m.id) as message_count
-            FROM users u
-            LEFT JOIN messages m ON u.username = m.sender
-            GROUP BY u.username, u.created_at
-            ORDER BY message_count DESC
-        """)
-        
+        with self._read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM messages WHERE recipient = 'GROUP'").fetchone()[0]
+
+    def get_message_counts(self, day: date = None) -> Dict:
+        """Totals used to seed the stats counters, read in one consistent snapshot."""
+        day = day or datetime.now().date()
+        with self._read() as conn:
+            row = conn.execute(
+                """
+                SELECT
+                    (SELECT COUNT(*) FROM users),
+                    (SELECT COUNT(*) FROM messages),
+                    (SELECT COUNT(*) FROM messages WHERE timestamp >= ? AND timestamp < ?),
+                    (SELECT COUNT(*) FROM messages WHERE recipient = 'GROUP'),
+                    (SELECT COALESCE(MAX(id), 0) FROM messages)
+                """,
+                (day.isoformat(), (day + timedelta(days=1)).isoformat())
+            ).fetchone()
+        return {
+            'total_users': row[0],
+            'total_messages': row[1],
+            'messages_today': row[2],
+            'group_messages': row[3],
+            'max_message_id': row[4]
+        }
+
+    def get_all_users_with_stats(self, sort: str = 'message_count', descending: bool = True,
+                                 limit: int = None, offset: int = 0) -> List[Dict]:
+        """
+        Get users with their stats, one page at a time.
+        Stats come from the trigger-maintained user_stats table, and every sort
+        order has an index, so a page costs the same however many messages exist.
+        """
+        table, column = self.USER_SORT_COLUMNS.get(sort, self.USER_SORT_COLUMNS['message_count'])
+        direction = 'DESC' if descending else 'ASC'
+        # Ties are broken by username in the same direction, so the index covers the order
+        columns = [column] if column == 'username' else [column, 'username']
+        order_by = ', '.join(f'{name} {direction}' for name in columns)
+        alias = 'u' if table == 'users' else 's'
+
+        with self._read() as conn:
+            cursor = conn.cursor()
+            # Skip to the page on the sort index alone, then join just that page
+            cursor.execute(f"""
+                SELECT u.username, u.created_at, s.message_count, s.last_active, s.bytes_uploaded
+                FROM (
+                    SELECT username FROM {table}
+                    ORDER BY {order_by}
+                    LIMIT ? OFFSET ?
+                ) page
+                JOIN users u ON u.username = page.username
+                JOIN user_stats s ON s.username = page.username
+                ORDER BY {', '.join(f'{alias}.{name} {direction}' for name in columns)}
+            """, (-1 if limit is None else limit, offset))
+            rows = cursor.fetchall()
+
         users = []
-        for row in cursor.fetchall():
+        for row in rows:
             users.append({
                 "username": row[0],
                 "created_at": row[1],
-                "message_count": row[2]
+                "message_count": row[2],
+                "last_active": row[3],
+                "bytes_uploaded": row[4]
             })
-        
-        conn.close()
+
         return users
 
+    def add_uploaded_bytes(self, username: str, size: int):
+        """Add an upload's size to a user's stats."""
+        with self._write() as conn:
+            conn.execute(
+                'UPDATE user_stats SET bytes_uploaded = bytes_uploaded + ? WHERE username = ?',
+                (size, username)
+            )
+
     def get_all_messages(self, limit: int = 500) -> List[Dict]:
         """Get all messages from the system."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT sender, recipient, message, timestamp
-            FROM messages
-            ORDER BY timestamp DESC
-            LIMIT ?
-        """, (limit,))
-        
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT sender, recipient, message, timestamp
+                FROM messages
+                ORDER BY timestamp DESC
+                LIMIT ?
+            """, (limit,))
+            rows = cursor.fetchall()
+
         messages = []
-        for row in cursor.fetchall():
+        for row in rows:
             messages.append({
                 "sender": row[0],
                 "recipient": row[1],
                 "message": row[2],
                 "timestamp": row[3]
             })
-        
-        conn.close()
+
         return list(reversed(messages))
+
+    # Columns of the rows returned by get_messages_for_export, in order
+    EXPORT_COLUMNS = ('id', 'sender', 'recipient', 'message', 'timestamp',
+                      'edited', 'deleted', 'reply_to', 'file_url', 'file_type')
+
+    def get_messages_for_export(self, after_id: int = 0, limit: int = 1000, since: str = None,
+                                until: str = None, sender: str = None, recipient: str = None) -> List[tuple]:
+        """
+        One batch of messages for an export, oldest first, as raw tuples (see EXPORT_COLUMNS).
+        Pass the last id of a batch as after_id to get the next one; an empty
+        list means the export is complete. Filters: since <= timestamp < until,
+        sender, recipient.
+        """
+        conditions, params = ['id > ?'], [after_id]
+        # Unary + keeps SQLite walking the table in id order instead of sorting
+        # every match of a sender/recipient index per batch, so a whole export
+        # is one linear pass however it is filtered
+        if since is not None:
+            conditions.append('+timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('+timestamp < ?')
+            params.append(until)
+        if sender is not None:
+            conditions.append('+sender = ?')
+            params.append(sender)
+        if recipient is not None:
+            conditions.append('+recipient = ?')
+            params.append(recipient)
+
+        with self._read() as conn:
+            return conn.execute(
+                f"""
+                SELECT {', '.join(self.EXPORT_COLUMNS)}
+                FROM messages
+                WHERE {' AND '.join(conditions)}
+                ORDER BY id
+                LIMIT ?
+                """,
+                params + [limit]
+            ).fetchall()
+
     # Enhanced Features Methods
-    
+
     def update_user_status(self, username: str, status: str, status_message: str = ''):
         '''Update user status.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE users SET status = ?, status_message = ? WHERE username = ?',
-            (status, status_message, username)
-        )
-        conn.commit()
-        conn.close()
+        with self._write() as conn:
+            conn.execute(
+                'UPDATE users SET status = ?, status_message = ? WHERE username = ?',
+                (status, status_message, username)
+            )
 
     def get_user_info(self, username: str) -> Dict:
         '''Get user information.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT username, avatar_color, status, status_message FROM users WHERE username = ?',
-            (username,)
-        )
-        result = cursor.fetchone()
-        conn.close()
-        
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT username, avatar_color, status, status_message FROM users WHERE username = ?',
+                (username,)
+            )
+            result = cursor.fetchone()
+
         if result:
             return {
                 'username': result[0],
@@ -341,137 +619,94 @@ class Database:
 
     def update_message(self, message_id: int, new_text: str):
         '''Edit a message.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE messages SET message = ?, edited = 1 WHERE id = ?',
-            (new_text, message_id)
-        )
-        conn.commit()
-        conn.close()
-
-    def delete_message(self, message_id: int):
-        '''Delete a message (soft delete).'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE messages SET deleted = 1 WHERE id = ?',
-            (message_id,)
-        )
-        conn.commit()
-        conn.close()
+        with self._write() as conn:
+            conn.execute(
+                'UPDATE messages SET message = ?, edited = 1 WHERE id = ?',
+                (new_text, message_id)
+            )
+
+    def delete_message(self, message_id: int) -> Optional[str]:
+        '''
+        Delete a message (soft delete).
+        Returns the message's file_url if no other live message references it.
+        '''
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT file_url FROM messages WHERE id = ? AND deleted = 0',
+                (message_id,)
+            ).fetchone()
+            conn.execute(
+                'UPDATE messages SET deleted = 1 WHERE id = ?',
+                (message_id,)
+            )
+            if row is None or row[0] is None:
+                return None
+            if conn.execute(
+                'SELECT 1 FROM messages WHERE file_url = ? AND deleted = 0 LIMIT 1',
+                (row[0],)
+            ).fetchone():
+                return None
+            return row[0]
 
     def add_reaction(self, message_id: int, username: str, emoji: str):
         '''Add a reaction to a message.'''
-        try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            timestamp = datetime.now().isoformat()
-            cursor.execute(
-                'INSERT INTO reactions (message_id, username, emoji, timestamp) VALUES (?, ?, ?, ?)',
-                (message_id, username, emoji, timestamp)
-            )
-            conn.commit()
-            conn.close()
-            return True
-        except sqlite3.IntegrityError:
-            # Reaction already exists, remove it
-            conn = self._get_connection()
+        with self._write() as conn:
+            try:
+                timestamp = datetime.now().isoformat()
+                conn.execute(
+                    'INSERT INTO reactions (message_id, username, emoji, timestamp) VALUES (?, ?, ?, ?)',
+                    (message_id, username, emoji, timestamp)
+                )
+                return True
+            except sqlite3.IntegrityError:
+                # Reaction already exists, remove it
+                conn.execute(
+                    'DELETE FROM reactions WHERE message_id = ? AND username = ? AND emoji = ?',
+                    (message_id, username, emoji)
+                )
+                return False
+
+    def get_message_reactions(self, message_id: int) -> List[Dict]:
+        '''Get reactions for a message.'''
+        with self._read() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                'DELETE FROM reactions WHERE message_id = ? AND username = ? AND emoji = ?',
-                (message_id, username, emoji)
+                'SELECT emoji, username FROM reactions WHERE message_id = ? ORDER BY id',
+                (message_id,)
             )
-            conn.commit()
-            conn.close()
-            return False
+            rows = cursor.fetchall()
 
-    def get_message_reactions(self, message_id: int) -> List[Dict]:
-        '''Get reactions for a message.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT emoji, username FROM reactions WHERE message_id = ?',
-            (message_id,)
-        )
         reactions = []
-        for row in cursor.fetchall():
+        for row in rows:
             reactions.append({
                 'emoji': row[0],
                 'username': row[1]
             })
-        conn.close()
         return reactions
 
-    def save_message_with_id(self, sender: str, recipient: str, message: str, timestamp: str, reply_to: int = None, file_url: str = None, file_type: str = None) -> int:
-        '''Save a message and return its ID.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'INSERT INTO messages (sender, recipient, message, timestamp, reply_to, file_url, file_type) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (sender, recipient, message, timestamp, reply_to, file_url, file_type)
-        )
-        
-        message_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return message_id
+    def _get_reactions_for(self, conn, message_ids: List[int]) -> Dict[int, List[Dict]]:
+        '''Fetch reactions for a page of messages in one query.'''
+        reactions = {message_id: [] for message_id in message_ids}
+        if not message_ids:
+            return reactions
 
-    def get_group_messages_enhanced(self, limit: int = 100) -> List[Dict]:
-        '''Get group chat messages with enhanced fields.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''
-            SELECT id, sender, message, timestamp, edited, deleted, reply_to, file_url, file_type
-            FROM messages
-            WHERE recipient = 'GROUP' AND deleted = 0
-            ORDER BY timestamp DESC
-            LIMIT ?
-            ''',
-            (limit,)
+        placeholders = ','.join('?' * len(message_ids))
+        cursor = conn.execute(
+            f'SELECT message_id, emoji, username FROM reactions WHERE message_id IN ({placeholders}) ORDER BY id',
+            message_ids
         )
-        
-        messages = []
         for row in cursor.fetchall():
-            msg = {
-                'id': row[0],
-                'sender': row[1],
-                'message': row[2],
-                'timestamp': row[3],
-                'edited': bool(row[4]),
-                'deleted': bool(row[5]),
-                'reply_to': row[6],
-                'file_url': row[7],
-                'file_type': row[8],
-                'reactions': self.get_message_reactions(row[0])
-            }
-            messages.append(msg)
-        
-        conn.close()
-        return list(reversed(messages))
+            reactions[row[0]].append({
+                'emoji': row[1],
+                'username': row[2]
+            })
+        return reactions
 
-    def get_private_messages_enhanced(self, user1: str, user2: str, limit: int = 100) -> List[Dict]:
-        '''Get private messages with enhanced fields.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''
-            SELECT id, sender, message, timestamp, edited, deleted, reply_to, file_url, file_type
-            FROM messages
-            WHERE ((sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)) AND deleted = 0
-            ORDER BY timestamp DESC
-            LIMIT ?
-            ''',
-            (user1, user2, user2, user1, limit)
-        )
-        
+    def _build_enhanced_messages(self, rows, reactions: Dict[int, List[Dict]]) -> List[Dict]:
+        '''Turn newest-first message rows into an oldest-first history page.'''
         messages = []
-        for row in cursor.fetchall():
-            msg = {
+        for row in reversed(rows):
+            messages.append({
                 'id': row[0],
                 'sender': row[1],
                 'message': row[2],
@@ -481,43 +716,142 @@ class Database:
                 'reply_to': row[6],
                 'file_url': row[7],
                 'file_type': row[8],
-                'reactions': self.get_message_reactions(row[0])
-            }
-            messages.append(msg)
-        
-        conn.close()
-        return list(reversed(messages))
+                'thumbnail_url': row[9],
+                'placeholder': row[10],
+                'reactions': reactions.get(row[0], [])
+            })
+        return messages
 
-    def search_messages(self, query: str, username: str = None) -> List[Dict]:
-        '''Search messages by content.'''
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        if username:
+    def save_message_with_id(self, sender: str, recipient: str, message: str, timestamp: str, reply_to: int = None, file_url: str = None, file_type: str = None) -> int:
+        '''Save a message and return its ID.'''
+        with self._write() as conn:
+            cursor = conn.cursor()
             cursor.execute(
-                '''
-                SELECT id, sender, recipient, message, timestamp
-                FROM messages
-                WHERE (sender = ? OR recipient = ?) AND message LIKE ? AND deleted = 0
-                ORDER BY timestamp DESC
-                LIMIT 50
-                ''',
-                (username, username, f'%{query}%')
+                'INSERT INTO messages (sender, recipient, message, timestamp, reply_to, file_url, file_type) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sender, recipient, message, timestamp, reply_to, file_url, file_type)
             )
+            message_id = cursor.lastrowid
+
+        return message_id
+
+    def set_file_preview(self, file_url: str, thumbnail_url: str, placeholder: str):
+        '''Record the thumbnail and placeholder of an image on every message sharing it.'''
+        with self._write() as conn:
+            conn.execute(
+                'UPDATE messages SET thumbnail_url = ?, placeholder = ? WHERE file_url = ?',
+                (thumbnail_url, placeholder, file_url)
+            )
+
+    def _get_history_page(self, branches: List[tuple], limit: int, before_id: int = None, after_id: int = None) -> List[Dict]:
+        '''
+        Fetch one page of a conversation using the message id as a cursor.
+        With after_id, returns the oldest messages newer than it (incremental sync);
+        otherwise the newest messages, older than before_id when given.
+
+        :param branches: (condition, params) pairs, one per index range making up the
+            conversation. Each is walked in id order separately and the results merged,
+            so every page costs the same no matter how deep the cursor is.
+        '''
+        if after_id is not None:
+            cursor_sql, cursor_params, order = ' AND id > ?', [after_id], 'ASC'
+        elif before_id is not None:
+            cursor_sql, cursor_params, order = ' AND id < ?', [before_id], 'DESC'
         else:
-            cursor.execute(
+            cursor_sql, cursor_params, order = '', [], 'DESC'
+
+        selects = []
+        params = []
+        for condition, branch_params in branches:
+            selects.append(
+                f'''
+                SELECT * FROM (
+                    SELECT id, sender, message, timestamp, edited, deleted, reply_to, file_url, file_type,
+                           thumbnail_url, placeholder
+                    FROM messages
+                    WHERE {condition}{cursor_sql}
+                    ORDER BY id {order}
+                    LIMIT ?
+                )
                 '''
-                SELECT id, sender, recipient, message, timestamp
-                FROM messages
-                WHERE message LIKE ? AND deleted = 0
-                ORDER BY timestamp DESC
-                LIMIT 50
-                ''',
-                (f'%{query}%',)
             )
-        
+            params.extend(branch_params)
+            params.extend(cursor_params)
+            params.append(limit)
+        params.append(limit)
+
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                ' UNION ALL '.join(selects) + f' ORDER BY id {order} LIMIT ?',
+                params
+            )
+            rows = cursor.fetchall()
+            reactions = self._get_reactions_for(conn, [row[0] for row in rows])
+
+        if order == 'ASC':
+            rows.reverse()
+        return self._build_enhanced_messages(rows, reactions)
+
+    def get_group_messages_enhanced(self, limit: int = 100, before_id: int = None, after_id: int = None) -> List[Dict]:
+        '''Get group chat messages with enhanced fields.'''
+        return self._get_history_page(
+            [("recipient = 'GROUP' AND deleted = 0", ())],
+            limit, before_id, after_id
+        )
+
+    def get_private_messages_enhanced(self, user1: str, user2: str, limit: int = 100, before_id: int = None, after_id: int = None) -> List[Dict]:
+        '''Get private messages with enhanced fields.'''
+        branches = [('sender = ? AND recipient = ? AND deleted = 0', (user1, user2))]
+        if user1 != user2:
+            branches.append(('sender = ? AND recipient = ? AND deleted = 0', (user2, user1)))
+        return self._get_history_page(branches, limit, before_id, after_id)
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        '''Turn free text into an FTS5 query: every word must match, the last one as a prefix.'''
+        terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+        if not terms:
+            return ''
+        terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search_messages(self, query: str, username: str = None, limit: int = 50) -> List[Dict]:
+        '''Search messages by content, best matches first.'''
+        fts_query = self._fts_query(query)
+        if not fts_query:
+            return []
+
+        with self._read() as conn:
+            cursor = conn.cursor()
+
+            if username:
+                cursor.execute(
+                    '''
+                    SELECT m.id, m.sender, m.recipient, m.message, m.timestamp
+                    FROM messages_fts
+                    JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ? AND (m.sender = ? OR m.recipient = ?)
+                    ORDER BY messages_fts.rank, m.timestamp DESC
+                    LIMIT ?
+                    ''',
+                    (fts_query, username, username, limit)
+                )
+            else:
+                cursor.execute(
+                    '''
+                    SELECT m.id, m.sender, m.recipient, m.message, m.timestamp
+                    FROM messages_fts
+                    JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?
+                    ORDER BY messages_fts.rank, m.timestamp DESC
+                    LIMIT ?
+                    ''',
+                    (fts_query, limit)
+                )
+            rows = cursor.fetchall()
+
         messages = []
-        for row in cursor.fetchall():
+        for row in rows:
             messages.append({
                 'id': row[0],
                 'sender': row[1],
@@ -525,22 +859,17 @@ class Database:
                 'message': row[3],
                 'timestamp': row[4]
             })
-        
-        conn.close()
+
         return messages
 
     def mark_message_read(self, message_id: int, username: str):
         '''Mark a message as read.'''
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            read_at = datetime.now().isoformat()
-            cursor.execute(
-                'INSERT INTO read_receipts (message_id, username, read_at) VALUES (?, ?, ?)',
-                (message_id, username, read_at)
-            )
-            conn.commit()
-            conn.close()
+            with self._write() as conn:
+                read_at = datetime.now().isoformat()
+                conn.execute(
+                    'INSERT INTO read_receipts (message_id, username, read_at) VALUES (?, ?, ?)',
+                    (message_id, username, read_at)
+                )
         except sqlite3.IntegrityError:
             pass  # Already marked as read
-
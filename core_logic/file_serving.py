@@ -0,0 +1,188 @@
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+from .uploads import IMMUTABLE_CACHE_CONTROL, UploadStore, content_etag
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single 'bytes=' range into inclusive (start, end) offsets.
+    Returns None for anything this server answers with the whole file
+    (other units, several ranges, malformed values).
+    :raises ValueError: If the range cannot be satisfied for this size.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+
+    if start is None:  # Suffix range: the last N bytes
+        if not end or size == 0:
+            raise ValueError("Unsatisfiable suffix range")
+        return max(0, size - end), size - 1
+    if end is None:
+        end = size - 1
+    elif start > end:
+        return None
+    if start >= size:
+        raise ValueError("Range starts past the end of the file")
+    return start, min(end, size - 1)
+
+
+def accepts_gzip(header: Optional[str]) -> bool:
+    """True if an Accept-Encoding header allows gzip."""
+    for coding in (header or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            q = params.strip()
+            try:
+                return not (q.startswith("q=") and float(q[2:]) == 0)
+            except ValueError:
+                return False
+    return False
+
+
+class RangeFileResponse(Response):
+    """
+    Sends a whole file or one byte range of it.
+
+    Uses the ASGI zero-copy send extensions when the server offers them, so
+    the kernel moves file pages straight to the socket; otherwise the file
+    is streamed in chunks from a worker thread.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, size: int, headers: dict, start: int = 0, end: int = None,
+                 status_code: int = 200):
+        self.path = path
+        self.start = start
+        self.end = size - 1 if end is None else end
+        self.status_code = status_code
+        self.background = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+        if scope["method"].upper() == "HEAD" or count <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "offset": self.start,
+                    "count": count,
+                })
+            return
+        if "http.response.pathsend" in extensions and self.start == 0 and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+
+        async with await anyio.open_file(self.path, "rb") as file:
+            await file.seek(self.start)
+            remaining = count
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b""})
+
+
+class UploadFiles(StaticFiles):
+    """
+    StaticFiles for the upload directory.
+
+    - Range requests (one range per request) so audio/video can seek.
+    - Conditional GETs via If-None-Match / If-Modified-Since, and If-Range.
+    - Content-addressed files and their thumbnails get a strong ETag
+      (derived from the SHA-256) and an immutable, year-long Cache-Control,
+      so browsers fetch each file once no matter how many messages share it.
+    - A stored gzip variant is sent to clients that accept it.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        relative = Path(self.get_path(scope)).as_posix()
+
+        etag = content_etag(relative)
+        headers = {
+            "accept-ranges": "bytes",
+            "content-type": self._media_type(full_path),
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        }
+        if etag is not None:
+            headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            tag = f"{stat_result.st_mtime}-{stat_result.st_size}"
+            etag = f'"{hashlib.md5(tag.encode()).hexdigest()}"'
+        headers["etag"] = etag
+
+        path, size = full_path, stat_result.st_size
+        http_range = request_headers.get("range")
+        variant = f"{full_path}{UploadStore.GZIP_SUFFIX}"
+        has_variant = os.path.splitext(relative)[1].lower() in UploadStore.COMPRESSIBLE_EXTENSIONS \
+            and os.path.isfile(variant)
+        if has_variant:
+            headers["vary"] = "Accept-Encoding"
+            if http_range is None and accepts_gzip(request_headers.get("accept-encoding")):
+                path, size = variant, os.stat(variant).st_size
+                headers["content-encoding"] = "gzip"
+                headers["etag"] = etag[:-1] + '-gzip"'
+
+        if self.is_not_modified(headers, request_headers):
+            return NotModifiedResponse(headers)
+
+        if http_range is not None and self._range_applies(request_headers, headers):
+            try:
+                byte_range = parse_range(http_range, size)
+            except ValueError:
+                return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+            if byte_range is not None:
+                start, end = byte_range
+                headers["content-range"] = f"bytes {start}-{end}/{size}"
+                headers["content-length"] = str(end - start + 1)
+                return RangeFileResponse(path, size, headers, start, end, status_code=206)
+
+        headers["content-length"] = str(size)
+        return RangeFileResponse(path, size, headers, status_code=status_code)
+
+    @staticmethod
+    def _media_type(full_path) -> str:
+        return guess_type(str(full_path))[0] or "application/octet-stream"
+
+    @staticmethod
+    def _range_applies(request_headers: Headers, headers: dict) -> bool:
+        """If-Range: only honour the range if the client's copy is still current."""
+        if_range = request_headers.get("if-range")
+        if if_range is None:
+            return True
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == headers["etag"]
+        try:
+            return parsedate_to_datetime(if_range) >= parsedate_to_datetime(headers["last-modified"])
+        except (TypeError, ValueError):
+            return False
@@ -0,0 +1,266 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+from .managers import ConnectionManager
+
+# Loads a page from the database: (limit, before_id, after_id) -> messages, oldest first
+PageLoader = Callable[[int, Optional[int], Optional[int]], Awaitable[List[Dict]]]
+
+
+def _message_id(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def conversation_key(sender: str, recipient: str) -> str:
+    """Cache key of the conversation a message belongs to."""
+    if recipient == "GROUP":
+        return "GROUP"
+    return "\x00".join(sorted((sender, recipient)))
+
+
+class _Conversation:
+    """
+    The newest messages of one conversation, oldest first.
+
+    Always holds every live message from its oldest entry onwards; 'complete'
+    means it also reaches back to the start of the conversation.
+    """
+
+    __slots__ = ("messages", "ids", "complete")
+
+    def __init__(self, messages: List[Dict], complete: bool):
+        self.messages = messages
+        self.ids = [message["id"] for message in messages]
+        self.complete = complete
+
+    def page(self, limit: int, before_id: int = None, after_id: int = None) -> Optional[List[Dict]]:
+        """The same page the database would return, or None if it is not all cached."""
+        if after_id is not None:
+            if not self.complete and (not self.ids or after_id < self.ids[0]):
+                return None
+            start = bisect_right(self.ids, after_id)
+            return self.messages[start:start + limit]
+
+        end = len(self.ids) if before_id is None else bisect_left(self.ids, before_id)
+        if end >= limit:
+            return self.messages[end - limit:end]
+        return self.messages[:end] if self.complete else None
+
+    def index(self, message_id: int) -> Optional[int]:
+        index = bisect_left(self.ids, message_id)
+        if index < len(self.ids) and self.ids[index] == message_id:
+            return index
+        return None
+
+
+class HistoryCache:
+    """
+    Recent history of the busiest conversations, kept in memory.
+
+    Each conversation holds up to `capacity` of its newest messages (with
+    reactions), exactly as the database returns them, so get_history for a
+    recent page never touches SQLite. The group room is always kept; direct
+    conversations are evicted least-recently-used beyond `max_conversations`.
+    Memory is bounded by capacity * (max_conversations + 1) messages, about
+    30 MB with the defaults.
+
+    Saves, edits, deletes, reactions and thumbnails are applied locally and
+    sent through the manager's broker, so every node's cache sees every
+    node's writes. If the broker may have lost some of them, the whole cache
+    is dropped and refilled from the database on demand. A conversation is
+    loaded once on a miss; changes arriving while it loads are replayed on
+    top, so a fill never loses a concurrent write.
+    """
+
+    def __init__(self, manager: ConnectionManager, capacity: int = 200, max_conversations: int = 100):
+        """
+        :param manager: ConnectionManager whose broker carries cache updates.
+        :param capacity: Newest messages kept per conversation.
+        :param max_conversations: Direct conversations kept before evicting the coldest.
+        """
+        self.manager = manager
+        self.capacity = capacity
+        self.max_conversations = max_conversations
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict()
+        # message id -> key of the cached conversation holding it
+        self._locations: Dict[int, str] = {}
+        self._fills: Dict[str, asyncio.Future] = {}
+        # key -> updates received while that conversation is being loaded
+        self._pending: Dict[str, List[dict]] = {}
+        # Bumped by clear(), so fills started before it are not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        manager.subscribe("history", self._on_update)
+        manager.on_events_lost(self.clear)
+
+    def stats(self) -> Dict:
+        requests = self.hits + self.misses
+        return {
+            "conversations": len(self._conversations),
+            "messages": len(self._locations),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 4) if requests else 0.0,
+            "evictions": self.evictions,
+        }
+
+    async def get_page(self, key: str, limit: int, before_id: int = None, after_id: int = None,
+                       load: PageLoader = None) -> List[Dict]:
+        """
+        One page of history, from memory when possible.
+        :param load: Fetches the page from the database on a miss.
+        """
+        # Cursors come from clients: '5' means 5, anything that is not a number means no cursor
+        before_id = _message_id(before_id)
+        after_id = _message_id(after_id)
+        conversation = self._conversations.get(key)
+        if conversation is not None:
+            self._conversations.move_to_end(key)
+            page = conversation.page(limit, before_id, after_id)
+            if page is not None:
+                self.hits += 1
+                return page
+
+        self.misses += 1
+        if before_id is None and after_id is None and limit <= self.capacity:
+            messages = await self._fill(key, load)
+            return messages[-limit:]
+        return await load(limit, before_id, after_id)
+
+    async def _fill(self, key: str, load: PageLoader) -> List[Dict]:
+        """Load a conversation's newest messages, sharing one query between concurrent misses."""
+        fill = self._fills.get(key)
+        if fill is None:
+            fill = self._fills[key] = asyncio.ensure_future(self._load(key, load))
+        return await asyncio.shield(fill)
+
+    def clear(self):
+        """Forget every cached conversation; each is reloaded on its next miss."""
+        self._generation += 1
+        for key in list(self._conversations):
+            self._drop(key)
+
+    async def _load(self, key: str, load: PageLoader) -> List[Dict]:
+        generation = self._generation
+        self._pending[key] = []
+        try:
+            messages = await load(self.capacity, None, None)
+        finally:
+            pending = self._pending.pop(key)
+            del self._fills[key]
+        if generation != self._generation:
+            return messages  # Cleared meanwhile; may predate changes that were lost
+
+        conversation = _Conversation(messages, complete=len(messages) < self.capacity)
+        self._store(key, conversation)
+        for update in pending:
+            self._apply(update)
+        return list(conversation.messages)
+
+    def _store(self, key: str, conversation: _Conversation):
+        self._drop(key)
+        self._conversations[key] = conversation
+        for message_id in conversation.ids:
+            self._locations[message_id] = key
+
+        # Evict the coldest direct conversations; the group room always stays
+        while len(self._conversations) > self.max_conversations + ("GROUP" in self._conversations):
+            for cold in self._conversations:
+                if cold != "GROUP":
+                    self._drop(cold)
+                    self.evictions += 1
+                    break
+
+    def _drop(self, key: str):
+        conversation = self._conversations.pop(key, None)
+        if conversation is not None:
+            for message_id in conversation.ids:
+                self._locations.pop(message_id, None)
+
+    # --- Updates: published to every node, applied in _on_update ---
+
+    async def message_saved(self, key: str, message: Dict):
+        """Record a new message (in the shape history pages use)."""
+        await self.manager.publish_event("history", {"action": "save", "key": key, "message": message})
+
+    async def message_edited(self, message_id: int, new_text: str):
+        await self._publish_change({"action": "edit", "id": message_id, "text": new_text})
+
+    async def message_deleted(self, message_id: int):
+        await self._publish_change({"action": "delete", "id": message_id})
+
+    async def reactions_changed(self, message_id: int, reactions: List[Dict]):
+        await self._publish_change({"action": "react", "id": message_id, "reactions": reactions})
+
+    async def _publish_change(self, update: dict):
+        # Ids come from clients; SQLite matches '12' to 12, so must the cache
+        update["id"] = _message_id(update["id"])
+        if update["id"] is not None:
+            await self.manager.publish_event("history", update)
+
+    async def preview_ready(self, file_url: str, thumbnail_url: str, placeholder: str):
+        """Attach a generated thumbnail to every cached message sharing a file."""
+        await self.manager.publish_event("history", {
+            "action": "preview",
+            "file_url": file_url,
+            "thumbnail_url": thumbnail_url,
+            "placeholder": placeholder
+        })
+
+    def _on_update(self, update: dict, frame: str):
+        # Conversations still loading may have read the database before this change
+        for key, pending in self._pending.items():
+            if update["action"] != "save" or update["key"] == key:
+                pending.append(update)
+        self._apply(update)
+
+    def _apply(self, update: dict):
+        action = update["action"]
+        if action == "save":
+            self._apply_save(update["key"], update["message"])
+        elif action == "preview":
+            for conversation in self._conversations.values():
+                for message in conversation.messages:
+                    if message["file_url"] == update["file_url"]:
+                        message["thumbnail_url"] = update["thumbnail_url"]
+                        message["placeholder"] = update["placeholder"]
+        else:
+            key = self._locations.get(update["id"])
+            if key is None:
+                return
+            conversation = self._conversations[key]
+            index = conversation.index(update["id"])
+            if index is None:
+                return
+            message = conversation.messages[index]
+            if action == "edit":
+                message["message"] = update["text"]
+                message["edited"] = True
+            elif action == "react":
+                message["reactions"] = update["reactions"]
+            elif action == "delete":
+                del conversation.ids[index]
+                del conversation.messages[index]
+                del self._locations[update["id"]]
+
+    def _apply_save(self, key: str, message: Dict):
+        conversation = self._conversations.get(key)
+        if conversation is None or message["id"] in self._locations:
+            return
+        if conversation.ids and message["id"] < conversation.ids[0] and not conversation.complete:
+            return  # Older than anything cached; would leave a gap
+        index = bisect_left(conversation.ids, message["id"])
+        conversation.ids.insert(index, message["id"])
+        conversation.messages.insert(index, message)
+        self._locations[message["id"]] = key
+
+        while len(conversation.ids) > self.capacity:
+            del self._locations[conversation.ids.pop(0)]
+            conversation.messages.pop(0)
+            conversation.complete = False
@@ -1,8 +1,19 @@
 import time
 
 class LeakyBucket:
-    """Implements the Leaky Bucket algorithm for rate limiting."""
-    
+    """
+    Implements the Leaky Bucket algorithm for rate limiting.
+
+    State is two floats in slots and is only brought up to date when the
+    bucket is checked. Time comes from time.monotonic(), so wall-clock
+    jumps (NTP, DST, manual changes) never cause spurious throttling or bursts.
+    """
+
+    __slots__ = ('capacity', 'leak_rate', '_current_level', '_last_leak_time')
+
+    # Stored state of a bucket nobody has used yet (see RateLimiter stores)
+    initial_state = 0.0
+
     def __init__(self, capacity: int, leak_rate: float):
         """
         :param capacity: The maximum number of messages the bucket can hold.
@@ -11,17 +22,33 @@ class LeakyBucket:
         self.capacity = capacity
         self.leak_rate = leak_rate
         self._current_level = 0.0
-        self._last_leak_time = time.time()
+        self._last_leak_time = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        """Sustained messages per second."""
+        return self.leak_rate
 
     def _leak(self):
         """Internal method to simulate the 'leaking' of messages over time."""
-        now = time.time()
+        now = time.monotonic()
         time_elapsed = now - self._last_leak_time
         leaked_amount = time_elapsed * self.leak_rate
-        
-        self._current_level = max(0, self._current_level - leaked_amount)
+
+        self._current_level = max(0.0, self._current_level - leaked_amount)
         self._last_leak_time = now
 
+    def apply(self, level: float, last_leak_time: float, now: float, amount: int = 1) -> tuple:
+        """
+        Runs the algorithm on state stored outside the bucket, so one bucket
+        can act as the template for many keys (see RateLimiter).
+        :return: (allowed, new_level, retry_after_seconds)
+        """
+        level = max(0.0, level - (now - last_leak_time) * self.leak_rate)
+        if level + amount <= self.capacity:
+            return True, level + amount, 0.0
+        return False, level, (level + amount - self.capacity) / self.leak_rate
+
     def add_message(self, amount: int = 1) -> bool:
         """
         Tries to add a message to the bucket.
@@ -29,9 +56,81 @@ class LeakyBucket:
         :return: True if the message was added, False if the bucket is full (spam).
         """
         self._leak()
-        
+
         if self._current_level + amount <= self.capacity:
             self._current_level += amount
             return True
         else:
-            return False
\ No newline at end of file
+            return False
+
+    def retry_after(self, amount: int = 1) -> float:
+        """
+        :return: Seconds until a message of this size would be accepted (0 if it would be now).
+        """
+        self._leak()
+        return max(0.0, (self._current_level + amount - self.capacity) / self.leak_rate)
+
+
+class TokenBucket:
+    """
+    Implements the Token Bucket algorithm for rate limiting.
+
+    The bucket starts full with `capacity` tokens (the allowed burst) and
+    refills at `refill_rate` tokens per second; each message spends tokens.
+    Same interface as LeakyBucket, so either can be used as a RateLimiter limit.
+    """
+
+    __slots__ = ('capacity', 'refill_rate', '_tokens', '_last_refill_time')
+
+    def __init__(self, capacity: int, refill_rate: float):
+        """
+        :param capacity: The maximum number of tokens (burst size).
+        :param refill_rate: Tokens added per second.
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = float(capacity)
+        self._last_refill_time = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        """Sustained messages per second."""
+        return self.refill_rate
+
+    @property
+    def initial_state(self) -> float:
+        """Stored state of a bucket nobody has used yet: full of tokens."""
+        return float(self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill_time) * self.refill_rate)
+        self._last_refill_time = now
+
+    def apply(self, tokens: float, last_refill_time: float, now: float, amount: int = 1) -> tuple:
+        """
+        Runs the algorithm on state stored outside the bucket.
+        :return: (allowed, new_tokens, retry_after_seconds)
+        """
+        tokens = min(self.capacity, tokens + (now - last_refill_time) * self.refill_rate)
+        if tokens >= amount:
+            return True, tokens - amount, 0.0
+        return False, tokens, (amount - tokens) / self.refill_rate
+
+    def add_message(self, amount: int = 1) -> bool:
+        """
+        Tries to spend tokens for a message.
+        :return: True if the message is allowed, False if not enough tokens are left.
+        """
+        self._refill()
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return True
+        return False
+
+    def retry_after(self, amount: int = 1) -> float:
+        """
+        :return: Seconds until a message of this size would be accepted (0 if it would be now).
+        """
+        self._refill()
+        return max(0.0, (amount - self._tokens) / self.refill_rate)
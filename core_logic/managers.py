@@ -1,127 +1,504 @@
-import datetime  # <--- THIS IS THE FIX
+import asyncio
+import json
+import uuid
 from fastapi import WebSocket
-from typing import List, Dict, Set
+from collections import deque
+from typing import Callable, List, Dict, Set
+from .brokers import Broker, InProcessBroker
 
-# --- Manager for the /logs dashboard ---
-class LogManager:
-    """Manages active WebSocket connections for the log dashboard."""
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+def encode_frame(message: dict) -> str:
+    """Serializes a message to a JSON text frame (uses orjson when installed)."""
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
 
-    async def broadcast_log(self, message: str):
-        """Broadcasts a log message to all connected admins."""
-        for connection in list(self.active_connections):
-            try:
-                await connection.send_text(message)
-            except:
-                self.disconnect(connection)
+
+# --- Per-socket outbound queue ---
+class ClientConnection:
+    """
+    One chat WebSocket with its own bounded outbound queue.
+
+    Pre-encoded frames are enqueued without awaiting the network; a dedicated
+    writer task drains the queue, so a slow client only ever delays itself.
+    """
+
+    def __init__(self, username: str, websocket: WebSocket, max_queue: int):
+        self.username = username
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, frame: str) -> bool:
+        """Queue an encoded frame for delivery. Returns False if the queue is full."""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _write_loop(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            pass
+        except:
+            pass # Disconnect will be handled by main loop
+
+    def stop(self):
+        """Stop the writer task, dropping anything still queued."""
+        self._writer.cancel()
+
+    async def close(self, code: int = 1000):
+        """Stop the writer and close the socket."""
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except:
+            pass
 
 # --- Manager for the /chat app ---
 class ConnectionManager:
-    """Manages active chat WebSocket connections."""
-    
-    def __init__(self):
-        # A simple mapping of WebSocket -> client_id (username)
-        self.client_ids: Dict[WebSocket, str] = {}
+    """
+    Manages active chat WebSocket connections.
+
+    Connections are indexed by username, and a user may hold several at once
+    (tabs/devices). Sends are enqueue operations on each connection's own
+    queue; a client whose queue overflows is disconnected instead of
+    holding up everyone else.
+
+    Presence is sent as a full snapshot to each new connection only. Users
+    going online/offline are coalesced over a short window and broadcast as
+    one joined/left delta, so a reconnect storm costs O(N) frames, not O(N²).
+
+    All outgoing events travel through a Broker, and every manager delivers
+    what the broker hands back to its own connections, so several workers or
+    nodes behave like one. Events are published as a one-line JSON header,
+    a newline, then the already-encoded client frame.
+    """
+
+    # Close code sent to clients that cannot keep up ("Try Again Later")
+    SLOW_CONSUMER_CLOSE_CODE = 1013
+
+    def __init__(self, max_queue: int = 256, presence_window: float = 0.25, broker: Broker = None,
+                 heartbeat_interval: float = 10.0, node_ttl: float = 30.0):
+        """
+        :param max_queue: Outbound messages buffered per connection before it is dropped.
+        :param presence_window: Seconds over which presence changes are coalesced.
+        :param broker: Pub/sub backplane shared with other workers (in-process by default).
+        :param heartbeat_interval: Seconds between announcements of this node's users.
+        :param node_ttl: Seconds without a heartbeat after which a node's users count as gone.
+        """
+        self.max_queue = max_queue
+        self.presence_window = presence_window
+        self.heartbeat_interval = heartbeat_interval
+        self.node_ttl = node_ttl
+        self._joined: Set[str] = set()
+        self._left: Set[str] = set()
+        self._presence_flush: asyncio.TimerHandle = None
+        self.active_connections: Dict[str, Set[ClientConnection]] = {}
+        self._by_socket: Dict[WebSocket, ClientConnection] = {}
+
+        self.node_id = uuid.uuid4().hex
+        self.broker = broker or InProcessBroker()
+        self.broker.subscribe(self._on_broker_message)
+        self.broker.on_lost(self._on_events_lost)
+        # username -> ids of the nodes the user is connected to, and the reverse
+        self._online_nodes: Dict[str, Set[str]] = {}
+        self._node_users: Dict[str, Set[str]] = {}
+        # node id -> loop time of its last presence, hello or heartbeat event
+        self._node_seen: Dict[str, float] = {}
+        self._heartbeat_task: asyncio.Task = None
+        self._event_handlers: Dict[str, List[Callable[[dict, str], None]]] = {}
+        self._lost_handlers: List[Callable[[], None]] = []
+
+    async def start(self):
+        """Join the backplane and ask the other nodes who is online."""
+        await self.broker.start()
+        await self._publish({"op": "hello", "node": self.node_id})
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def close(self):
+        """Announce this node's users as gone and leave the backplane."""
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        users = list(self.active_connections)
+        if users:
+            await self._publish({"op": "presence", "node": self.node_id, "joined": [], "left": users})
+        await self.broker.close()
+
+    def subscribe(self, op: str, handler: Callable[[dict, str], None]):
+        """
+        Register a handler for events published with publish_event(). Handlers
+        may also observe the built-in "presence" op, after it has been applied.
+        """
+        self._event_handlers.setdefault(op, []).append(handler)
+
+    def on_events_lost(self, handler: Callable[[], None]):
+        """
+        Register a callback for when events to or from other nodes may have
+        been lost, so state built from them should be reloaded.
+        """
+        self._lost_handlers.append(handler)
+
+    async def publish_event(self, op: str, event: dict, frame: str = ""):
+        """
+        Publish a custom event to every node. This node's handlers run straight
+        away rather than on the broker's echo, so local state does not depend
+        on the broker being up; other nodes get the event through the broker.
+        """
+        event = dict(event, op=op, origin=self.node_id)
+        self._dispatch_event(op, event, frame)
+        await self._publish(event, frame)
+
+    def _dispatch_event(self, op: str, event: dict, frame: str):
+        for handler in self._event_handlers.get(op, ()):
+            handler(event, frame)
+
+    def _on_events_lost(self):
+        for handler in list(self._lost_handlers):
+            handler()
+
+    async def _publish(self, event: dict, frame: str = ""):
+        await self.broker.publish(json.dumps(event, separators=(",", ":")) + "\n" + frame)
+
+    def _on_broker_message(self, payload: str):
+        header, _, frame = payload.partition("\n")
+        event = json.loads(header)
+        if event.get("origin") == self.node_id:
+            return  # Already handled when it was published
+        op = event["op"]
+        if op in ("presence", "hello", "heartbeat"):
+            self._node_seen[event["node"]] = asyncio.get_running_loop().time()
+        if op == "broadcast":
+            self._broadcast_frame(frame, event.get("exclude"))
+        elif op == "user":
+            self._send_frame_to_user(frame, event["username"])
+        elif op == "presence":
+            self._apply_presence(event["node"], event["joined"], event["left"])
+        elif op == "hello":
+            if event["node"] != self.node_id and self.active_connections:
+                asyncio.create_task(self._publish({
+                    "op": "presence",
+                    "node": self.node_id,
+                    "joined": list(self.active_connections),
+                    "left": []
+                }))
+        elif op == "heartbeat":
+            self._sync_node(event["node"], event["users"])
+        self._dispatch_event(op, event, frame)
+
+    async def _heartbeat(self):
+        """
+        Periodically announce this node's full user list and expire nodes
+        that went silent. A heartbeat also repairs any presence delta lost
+        while the broker was unreachable.
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self._publish({"op": "heartbeat", "node": self.node_id, "users": list(self.active_connections)})
+            self._expire_nodes()
+
+    def _sync_node(self, node: str, users: List[str]):
+        """Make the global view match a node's announced user list."""
+        known = self._node_users.get(node, set())
+        current = set(users)
+        self._apply_presence(node, sorted(current - known), sorted(known - current))
+
+    def _expire_nodes(self):
+        """Drop the users of nodes that crashed or lost the broker without saying goodbye."""
+        deadline = asyncio.get_running_loop().time() - self.node_ttl
+        for node, seen in list(self._node_seen.items()):
+            if node == self.node_id or seen >= deadline:
+                continue
+            del self._node_seen[node]
+            users = self._node_users.get(node)
+            if users:
+                print(f"Node {node} missed its heartbeats, marking {len(users)} users offline")
+                self._apply_presence(node, [], sorted(users))
 
     def get_online_users(self) -> List[str]:
-        """Returns a list of all current usernames."""
-        return list(self.client_ids.values())
+        """Returns a list of all current usernames, across all nodes."""
+        users = set(self._online_nodes)
+        users.update(self.active_connections)
+        return list(users)
 
-    async def connect(self, websocket: WebSocket, client_id: str):
+    def is_online(self, username: str) -> bool:
+        return username in self.active_connections or username in self._online_nodes
+
+    async def connect(self, username: str, websocket: WebSocket):
         """Accepts a new client connection."""
         await websocket.accept()
-        self.client_ids[websocket] = client_id
-        await self.broadcast_user_list()
-
-    async def disconnect(self, websocket: WebSocket) -> str:
-        """Removes a client connection and returns their ID."""
-        client_id = self.client_ids.pop(websocket, "Someone")
-        await self.broadcast_user_list()
-        return client_id
-
-    async def broadcast_user_list(self):
-        """Broadcasts the current user list to ALL connected clients."""
-        user_list = self.get_online_users()
-        msg_data = {
-            "type": "USER_LIST",
-            "users": user_list
-        }
-        for connection in self.client_ids.keys():
-            try:
-                await connection.send_json(msg_data)
-            except:
-                # Disconnect will be handled by main loop
-                pass
-
-    async def send_personal_json(self, data: dict, websocket: WebSocket):
-        """Sends a JSON message to a specific client only (Unicast)."""
-        try:
-            await websocket.send_json(data)
-        except:
-            pass # Disconnect will be handled by main loop
+        connection = ClientConnection(username, websocket, self.max_queue)
+        self._by_socket[websocket] = connection
+        first_connection = username not in self.active_connections
+        self.active_connections.setdefault(username, set()).add(connection)
+
+        # Full snapshot for the newcomer, a coalesced delta for everyone else
+        self._send(connection, encode_frame({
+            "type": "user_list",
+            "users": self.get_online_users()
+        }))
+        if first_connection:
+            self._presence_changed(username, online=True)
+
+    def disconnect(self, username: str, websocket: WebSocket) -> bool:
+        """
+        Removes a client connection.
+        :return: True if that was the user's last connection on this node.
+        """
+        connection = self._by_socket.pop(websocket, None)
+        if connection is None:
+            return False
+        connection.stop()
+
+        connections = self.active_connections.get(username)
+        if connections is not None:
+            connections.discard(connection)
+            if connections:
+                return False
+            del self.active_connections[username]
+        self._presence_changed(username, online=False)
+        return True
+
+    def _presence_changed(self, username: str, online: bool):
+        """Record a user going online/offline and schedule a delta broadcast."""
+        if online:
+            if username in self._left:
+                self._left.discard(username)  # Back before anyone was told
+            else:
+                self._joined.add(username)
+        else:
+            if username in self._joined:
+                self._joined.discard(username)  # Gone before anyone was told
+            else:
+                self._left.add(username)
+
+        if self._presence_flush is None:
+            loop = asyncio.get_running_loop()
+            self._presence_flush = loop.call_later(self.presence_window, self._flush_presence)
+
+    def _flush_presence(self):
+        """Publish all presence changes collected during the window."""
+        self._presence_flush = None
+        joined, left = self._joined, self._left
+        self._joined, self._left = set(), set()
+        if not joined and not left:
+            return
+        asyncio.create_task(self._publish({
+            "op": "presence",
+            "node": self.node_id,
+            "joined": sorted(joined),
+            "left": sorted(left)
+        }))
+
+    def _apply_presence(self, node: str, joined: List[str], left: List[str]):
+        """Fold one node's presence delta into the global view and tell local clients."""
+        went_online = []
+        for username in joined:
+            nodes = self._online_nodes.setdefault(username, set())
+            if not nodes:
+                went_online.append(username)
+            nodes.add(node)
+            self._node_users.setdefault(node, set()).add(username)
+
+        went_offline = []
+        for username in left:
+            nodes = self._online_nodes.get(username)
+            if nodes is None:
+                continue
+            nodes.discard(node)
+            if not nodes:
+                del self._online_nodes[username]
+                went_offline.append(username)
+            node_users = self._node_users.get(node)
+            if node_users is not None:
+                node_users.discard(username)
+                if not node_users:
+                    del self._node_users[node]
+
+        if went_online or went_offline:
+            self._broadcast_frame(encode_frame({
+                "type": "presence",
+                "joined": went_online,
+                "left": went_offline
+            }))
+
+    def _send(self, connection: ClientConnection, frame: str):
+        if not connection.enqueue(frame):
+            self._drop_slow_consumer(connection)
+
+    def _drop_slow_consumer(self, connection: ClientConnection):
+        """Disconnect a client whose outbound queue is full."""
+        self.disconnect(connection.username, connection.websocket)
+        asyncio.create_task(connection.close(code=self.SLOW_CONSUMER_CLOSE_CODE))
+
+    async def send_personal_message(self, message: dict, username: str):
+        """Sends a message to every connection of one user, on any node."""
+        if not self.is_online(username):
+            return
+        await self._publish({"op": "user", "username": username}, encode_frame(message))
+
+    async def broadcast(self, message: dict, exclude: str = None):
+        """Sends a message to every connected user, optionally skipping one."""
+        # Encode once; every recipient on every node gets the same frame
+        await self._publish({"op": "broadcast", "exclude": exclude}, encode_frame(message))
+
+    def broadcast_local(self, message: dict):
+        """Sends a message to every connection on this node only."""
+        self._broadcast_frame(encode_frame(message))
+
+    def send_to_connection(self, websocket: WebSocket, message: dict):
+        """
+        Replies on one socket only, e.g. to the tab that made a request.
+        Never published, so other tabs and other nodes do not see it.
+        """
+        connection = self._by_socket.get(websocket)
+        if connection is not None:
+            self._send(connection, encode_frame(message))
+
+    def send_local(self, message: dict, username: str):
+        """Sends a message to one user's connections on this node only."""
+        if username in self.active_connections:
+            self._send_frame_to_user(encode_frame(message), username)
+
+    def _send_frame_to_user(self, frame: str, username: str):
+        """Delivers a frame to one user's connections on this node."""
+        for connection in list(self.active_connections.get(username, ())):
+            self._send(connection, frame)
+
+    def _broadcast_frame(self, frame: str, exclude: str = None):
+        """Delivers a frame to every connection on this node."""
+        for username, connections in list(self.active_connections.items()):
+            if username == exclude:
+                continue
+            for connection in list(connections):
+                self._send(connection, frame)
+
+
+# --- Manager for the /admin dashboard ---
+class LogManager:
+    """
+    Pushes live updates to admin dashboard WebSockets.
+
+    Listens to the events every node already publishes on the manager's
+    broker (stats counters, saved messages, presence), so dashboards see the
+    whole cluster without any extra publishing. Changes are coalesced over a
+    short window into one frame per dashboard: a fresh stats snapshot (read
+    from memory, never the database), the new messages, who came online or
+    went offline, and log lines. With no dashboard open nothing is buffered
+    or scheduled, and an idle system sends nothing at all.
+    """
+
+    SLOW_CONSUMER_CLOSE_CODE = ConnectionManager.SLOW_CONSUMER_CLOSE_CODE
 
-    async def broadcast_message(self, sender: str, recipient: str, message: str):
+    def __init__(self, manager: ConnectionManager, snapshot: Callable[[], Dict], window: float = 1.0,
+                 max_queue: int = 32, max_messages: int = 100):
         """
-        Broadcasts a chat message to the relevant clients.
-        If recipient is 'GROUP', sends to all.
-        If recipient is a username, sends only to that user and the sender.
+        :param manager: ConnectionManager whose broker events are watched.
+        :param snapshot: Returns the current dashboard stats.
+        :param window: Seconds over which changes are coalesced into one frame.
+        :param max_queue: Frames buffered per dashboard before it is dropped.
+        :param max_messages: Newest messages kept per frame.
         """
-        msg_data = {
-            "type": "MESSAGE",
+        self.manager = manager
+        self.snapshot = snapshot
+        self.window = window
+        self.max_queue = max_queue
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        self._stats_changed = False
+        self._messages: deque = deque(maxlen=max_messages)
+        self._joined: Set[str] = set()
+        self._left: Set[str] = set()
+        self._logs: List[str] = []
+        self._flush: asyncio.TimerHandle = None
+        manager.subscribe("stats", self._on_stats)
+        manager.subscribe("history", self._on_history)
+        manager.subscribe("presence", self._on_presence)
+
+    async def connect(self, websocket: WebSocket):
+        """Accepts a dashboard and sends it the current stats."""
+        await websocket.accept()
+        connection = ClientConnection("admin", websocket, self.max_queue)
+        self.active_connections[websocket] = connection
+        connection.enqueue(encode_frame({"type": "snapshot", "stats": self.snapshot()}))
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self.active_connections.pop(websocket, None)
+        if connection is not None:
+            connection.stop()
+
+    async def broadcast_log(self, message: str):
+        """Sends a log line to every dashboard with the next update."""
+        if self.active_connections:
+            self._logs.append(message)
+            self._schedule()
+
+    def _on_stats(self, change: dict, frame: str):
+        if self.active_connections:
+            self._stats_changed = True
+            if change["action"] == "user":
+                self._logs.append("New user registered")
+            self._schedule()
+
+    def _on_history(self, update: dict, frame: str):
+        if not self.active_connections or update["action"] != "save":
+            return
+        message = update["message"]
+        # The conversation key is 'GROUP' or the two usernames (see conversation_key)
+        key, sender = update["key"], message["sender"]
+        recipient = "GROUP" if key == "GROUP" else next((u for u in key.split("\x00") if u != sender), sender)
+        self._messages.append({
+            "id": message["id"],
             "sender": sender,
             "recipient": recipient,
-            "message": message,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        
-        if recipient == 'GROUP':
-            # Broadcast to everyone
-            for connection in self.client_ids.keys():
-                try:
-                    await connection.send_json(msg_data)
-                except:
-                    pass
-        else:
-            # It's a DM, send only to sender and recipient
-            recipient_ws = self.get_websocket_by_username(recipient)
-            sender_ws = self.get_websocket_by_username(sender)
-            
-            if recipient_ws:
-                try:
-                    await recipient_ws.send_json(msg_data)
-                except:
-                    pass
-            if sender_ws:
-                 try:
-                    await sender_ws.send_json(msg_data)
-                 except:
-                    pass
-
-    async def broadcast_system_message(self, message: str):
-        """Broadcasts a system message to all connected clients."""
-        msg_data = {
-            "type": "SYSTEM",
-            "message": message,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        for connection in self.client_ids.keys():
-            try:
-                await connection.send_json(msg_data)
-            except:
-                pass
-
-    def get_websocket_by_username(self, username: str) -> WebSocket | None:
-        """Finds a WebSocket connection for a given username."""
-        for ws, client_id in self.client_ids.items():
-            if client_id == username:
-                return ws
-        return None
+            "message": message["message"],
+            "timestamp": message["timestamp"]
+        })
+        self._schedule()
+
+    def _on_presence(self, event: dict, frame: str):
+        if not self.active_connections:
+            return
+        # Presence deltas are per node; report the users' resulting cluster-wide state
+        for username in event["joined"] + event["left"]:
+            online = self.manager.is_online(username)
+            (self._joined if online else self._left).add(username)
+            (self._left if online else self._joined).discard(username)
+        self._stats_changed = True
+        self._schedule()
+
+    def _schedule(self):
+        if self._flush is None:
+            loop = asyncio.get_running_loop()
+            self._flush = loop.call_later(self.window, self._send_update)
+
+    def _send_update(self):
+        """Send everything collected during the window as one frame."""
+        self._flush = None
+        update = {"type": "update"}
+        if self._stats_changed:
+            update["stats"] = self.snapshot()
+        if self._messages:
+            update["messages"] = list(self._messages)
+        if self._joined or self._left:
+            update["joined"] = sorted(self._joined)
+            update["left"] = sorted(self._left)
+        if self._logs:
+            update["logs"] = self._logs
+        self._stats_changed = False
+        self._messages.clear()
+        self._joined, self._left, self._logs = set(), set(), []
+
+        frame = encode_frame(update)
+        for connection in list(self.active_connections.values()):
+            if not connection.enqueue(frame):
+                self.disconnect(connection.websocket)
+                asyncio.create_task(connection.close(code=self.SLOW_CONSUMER_CLOSE_CODE))
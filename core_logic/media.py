@@ -0,0 +1,118 @@
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable, Dict
+
+from .uploads import UploadStore
+
+try:
+    from PIL import Image, ImageFilter, ImageOps
+except ImportError:
+    Image = None
+
+
+def render_preview(source: str, thumbnail: str, max_side: int, placeholder_side: int) -> str:
+    """
+    Writes a WebP thumbnail of an image and returns a blurred placeholder as a
+    data URI. Runs in a worker process. An existing thumbnail is reused.
+    """
+    if not os.path.exists(thumbnail):
+        with Image.open(source) as image:
+            image.draft("RGB", (max_side, max_side))  # Decode JPEGs at reduced scale
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+            partial = f"{thumbnail}.{os.getpid()}{UploadStore.PARTIAL_SUFFIX}"
+            image.save(partial, "WEBP", quality=80, method=4)
+            os.replace(partial, thumbnail)
+
+    with Image.open(thumbnail) as image:
+        image.thumbnail((placeholder_side, placeholder_side))
+        tiny = image.convert("RGB").filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    tiny.save(buffer, "JPEG", quality=40)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+class MediaPipeline:
+    """
+    Background thumbnail and blur placeholder generation for image uploads.
+
+    Images are decoded and resized in a process pool so the server never
+    spends CPU on them. Each file is processed once, however many messages
+    share it; the result is recorded on every message carrying that file so
+    history payloads can point at the thumbnail instead of the original.
+    Needs Pillow; without it, images are simply served at full size.
+    """
+
+    def __init__(self, store: UploadStore, database, max_workers: int = None,
+                 max_side: int = 320, placeholder_side: int = 16,
+                 on_preview: Callable[[str, str, str], Awaitable[None]] = None):
+        """
+        :param store: UploadStore the images live in.
+        :param database: AsyncDatabase the previews are recorded in.
+        :param max_workers: Worker processes (defaults to the CPU count).
+        :param max_side: Longest side of a thumbnail in pixels.
+        :param placeholder_side: Longest side of the blurred placeholder in pixels.
+        :param on_preview: Awaited with (file_url, thumbnail_url, placeholder) once recorded.
+        """
+        self.store = store
+        self.database = database
+        self.max_workers = max_workers
+        self.max_side = max_side
+        self.placeholder_side = placeholder_side
+        self.on_preview = on_preview
+        self._executor: ProcessPoolExecutor = None
+        self._jobs: Dict[str, asyncio.Task] = {}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    @property
+    def queue_depth(self) -> int:
+        """Images waiting for or being processed."""
+        return len(self._jobs)
+
+    def submit(self, file_url: str):
+        """Schedule preview generation for an uploaded image (no-op if already queued)."""
+        if not self.available or file_url in self._jobs:
+            return
+        source = self.store.path_for_url(file_url)
+        if source is None:
+            return
+        task = asyncio.create_task(self._process(file_url, source))
+        self._jobs[file_url] = task
+        task.add_done_callback(lambda _: self._jobs.pop(file_url, None))
+
+    async def _process(self, file_url: str, source: Path):
+        if self._executor is None:
+            # Forking a threaded server can copy locks held by other threads into the
+            # child; forkserver (or spawn on Windows) starts workers from a clean process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        thumbnail = self.store.thumbnail_path(source)
+        loop = asyncio.get_running_loop()
+        try:
+            placeholder = await loop.run_in_executor(
+                self._executor, render_preview,
+                str(source), str(thumbnail), self.max_side, self.placeholder_side
+            )
+            thumbnail_url = self.store.url_for(thumbnail)
+            await self.database.set_file_preview(file_url, thumbnail_url, placeholder)
+            if self.on_preview is not None:
+                await self.on_preview(file_url, thumbnail_url, placeholder)
+        except Exception as e:
+            print(f"Preview failed for {file_url}: {e}")
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,159 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+# Hashes written before the KDF: unsalted SHA-256 hex digests
+LEGACY_HASH = re.compile(r"^[0-9a-f]{64}$")
+
+
+def hash_password(password: str, n: int, r: int, p: int) -> str:
+    """
+    Salted scrypt hash, stored as 'scrypt$n$r$p$salt$hash' (base64 fields).
+    Runs in a worker process.
+    """
+    salt = os.urandom(16)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+    return f"scrypt${n}${r}${p}${base64.b64encode(salt).decode()}${base64.b64encode(key).decode()}"
+
+
+def verify_password(password: str, stored: str, n: int, r: int, p: int) -> Tuple[bool, Optional[str]]:
+    """
+    Checks a password against a stored hash. Runs in a worker process.
+    :return: (matches, new_hash). new_hash is set when the password matched
+        a legacy SHA-256 hash or scrypt with other parameters, and should
+        replace the stored one.
+    """
+    if LEGACY_HASH.match(stored):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        if not hmac.compare_digest(legacy, stored):
+            return False, None
+        return True, hash_password(password, n, r, p)
+
+    try:
+        scheme, n_, r_, p_, salt, expected = stored.split("$")
+        params = (int(n_), int(r_), int(p_))
+        salt, expected = base64.b64decode(salt), base64.b64decode(expected)
+    except ValueError:
+        return False, None
+    if scheme != "scrypt":
+        return False, None
+    key = hashlib.scrypt(password.encode(), salt=salt, n=params[0], r=params[1], p=params[2],
+                         maxmem=256 * params[0] * params[1], dklen=len(expected))
+    if not hmac.compare_digest(key, expected):
+        return False, None
+    return True, None if params == (n, r, p) else hash_password(password, n, r, p)
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already waiting for a worker."""
+
+
+class PasswordHasher:
+    """
+    Salted, memory-hard password hashing (scrypt) off the event loop.
+
+    Each hash costs tens of milliseconds of CPU and 16 MB of memory with the
+    default parameters, so it runs in a process pool rather than on the
+    server. At most max_concurrent hashes run at once and at most
+    max_pending more may wait; beyond that, callers get PasswordHasherBusy
+    straight away, so a login storm is shed instead of queueing without
+    bound.
+
+    Stored hashes are looked up through a small LRU cache, so a login does
+    not need a database round trip for a user who logged in recently.
+    Legacy unsalted SHA-256 hashes still verify and are replaced with a
+    scrypt hash on the user's next successful login.
+    """
+
+    def __init__(self, database, max_workers: int = None, max_concurrent: int = None,
+                 max_pending: int = 64, cache_size: int = 1024, n: int = 2 ** 14, r: int = 8, p: int = 1):
+        """
+        :param database: AsyncDatabase holding the stored hashes.
+        :param max_workers: Worker processes (defaults to the CPU count).
+        :param max_concurrent: Hashes computed at once (defaults to max_workers).
+        :param max_pending: Hashes allowed to wait for a free worker.
+        :param cache_size: Stored hashes kept in memory.
+        :param n: scrypt CPU/memory cost (a power of two).
+        :param r: scrypt block size.
+        :param p: scrypt parallelism.
+        """
+        self.database = database
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_concurrent = max_concurrent or self.max_workers
+        self.max_pending = max_pending
+        self.cache_size = cache_size
+        self.params = (n, r, p)
+        self._executor: ProcessPoolExecutor = None
+        self._slots: asyncio.Semaphore = None
+        self._waiting = 0
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        # Checked for unknown users, so they take as long as real ones
+        self._dummy_hash: str = None
+
+    async def _run(self, func, *args):
+        if self._waiting >= self.max_pending + self.max_concurrent:
+            raise PasswordHasherBusy("Too many logins in progress")
+        if self._executor is None:
+            # Forking a threaded server can copy locks held by other threads into the
+            # child; forkserver (or spawn on Windows) starts workers from a clean process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._waiting += 1
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, func, *args, *self.params)
+        finally:
+            self._waiting -= 1
+
+    async def register(self, username: str, password: str) -> bool:
+        """Create a user with a hashed password. Returns False if the name is taken."""
+        password_hash = await self._run(hash_password, password)
+        if not await self.database.create_user(username, password_hash):
+            return False
+        self._remember(username, password_hash)
+        return True
+
+    async def verify(self, username: str, password: str) -> bool:
+        """Check a user's password, upgrading its stored hash if needed."""
+        stored = self._cache.get(username)
+        if stored is None:
+            stored = await self.database.get_password_hash(username)
+        if stored is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = await self._run(hash_password, "")
+            await self._run(verify_password, password, self._dummy_hash)
+            return False
+
+        matches, new_hash = await self._run(verify_password, password, stored)
+        if not matches:
+            self._cache.pop(username, None)  # Re-read next time in case it changed elsewhere
+            return False
+        if new_hash is not None:
+            if not await self.database.update_password_hash(username, stored, new_hash):
+                # Upgraded elsewhere meanwhile; read the new hash next time
+                self._cache.pop(username, None)
+                return True
+            stored = new_hash
+        self._remember(username, stored)
+        return True
+
+    def _remember(self, username: str, password_hash: str):
+        self._cache[username] = password_hash
+        self._cache.move_to_end(username)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,195 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict
+from .leaky_bucket import LeakyBucket
+from .resp import encode_command, read_reply, open_connection
+
+# Default limits per action: bucket capacity (burst) and leak rate (per second)
+DEFAULT_LIMITS = {
+    "message": LeakyBucket(capacity=5, leak_rate=1.0),
+    "react": LeakyBucket(capacity=10, leak_rate=2.0),
+    "search": LeakyBucket(capacity=5, leak_rate=0.5),
+    "upload": LeakyBucket(capacity=3, leak_rate=0.1),
+    "history": LeakyBucket(capacity=10, leak_rate=2.0),
+}
+
+
+class MemoryBucketStore:
+    """
+    Per-process bucket state for any number of keys.
+
+    Each key costs one (state, last_update_time) tuple. Entries are kept in
+    least-recently-used order, and every check evicts the oldest entries once
+    they have been idle long enough to have fully drained. An evicted key is
+    indistinguishable from an empty bucket, so eviction never changes a result.
+    """
+
+    def __init__(self):
+        self._states: Dict[str, OrderedDict] = {}
+
+    def __len__(self):
+        return sum(len(states) for states in self._states.values())
+
+    async def add(self, action: str, key: str, bucket, amount: int = 1) -> tuple:
+        states = self._states.get(action)
+        if states is None:
+            states = self._states[action] = OrderedDict()
+
+        now = time.monotonic()
+        level, last = states.pop(key, (bucket.initial_state, now))
+        allowed, level, retry_after = bucket.apply(level, last, now, amount)
+        states[key] = (level, now)
+
+        # Evict drained buckets from the cold end
+        drain_time = bucket.capacity / bucket.rate
+        while states:
+            _, oldest_last = next(iter(states.values()))
+            if now - oldest_last < drain_time:
+                break
+            states.popitem(last=False)
+
+        return allowed, retry_after
+
+    async def close(self):
+        pass
+
+
+class RedisBucketStore:
+    """
+    Bucket state kept in a Redis-compatible server so limits hold across
+    workers, nodes and reconnects. The algorithm runs atomically in a Lua
+    script using the server clock, and idle keys expire on their own.
+    Token buckets are stored as the equivalent leaky bucket level.
+
+    Rate limiting fails open: if the server is unreachable, slow or returns
+    an error, the action is allowed and the failure logged, so a Redis outage
+    cannot take chat down with it. A broken connection is discarded and
+    reopened on a later check, no more often than every retry_delay seconds.
+    """
+
+    # TIME is non-deterministic, so writes after it need effects replication:
+    # the default from Redis 5, opt-in with replicate_commands() on Redis 3.2-4
+    SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'level', 'last')
+local level = tonumber(state[1]) or 0
+local last = tonumber(state[2]) or now
+level = math.max(0, level - (now - last) * rate)
+local allowed = 0
+local retry_after = 0
+if level + amount <= capacity then
+    level = level + amount
+    allowed = 1
+else
+    retry_after = (level + amount - capacity) / rate
+end
+redis.call('HSET', KEYS[1], 'level', tostring(level), 'last', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(level / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+    def __init__(self, url: str, prefix: str = "mkchat:rl:", timeout: float = 1.0, retry_delay: float = 1.0):
+        """
+        :param url: redis://[:password@]host[:port] of the server.
+        :param prefix: Key prefix for bucket hashes.
+        :param timeout: Seconds to wait for the server before allowing the action.
+        :param retry_delay: Seconds to wait after a failure before reconnecting.
+        """
+        self.url = url
+        self.prefix = prefix
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._lock: asyncio.Lock = None
+        self._retry_at = 0.0
+
+    async def add(self, action: str, key: str, bucket, amount: int = 1) -> tuple:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        command = encode_command(
+            "EVAL", self.SCRIPT, 1, f"{self.prefix}{action}:{key}",
+            bucket.capacity, bucket.rate, amount
+        )
+        async with self._lock:
+            if self._writer is None and time.monotonic() < self._retry_at:
+                return True, 0.0
+            for attempt in range(2):
+                reused = self._writer is not None
+                try:
+                    allowed, retry_after = await asyncio.wait_for(self._call(command), self.timeout)
+                    break
+                except (OSError, TypeError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    if attempt == 0 and reused and not isinstance(e, asyncio.TimeoutError):
+                        continue  # Probably closed by a server restart; try once on a fresh connection
+                    print(f"Rate limit store unavailable ({e or type(e).__name__}), allowing {action}")
+                    self._retry_at = time.monotonic() + self.retry_delay
+                    return True, 0.0
+        return bool(allowed), float(retry_after)
+
+    async def _call(self, command: bytes):
+        """One request/reply; the connection is dropped unless the reply was read in full."""
+        try:
+            if self._writer is None:
+                self._reader, self._writer = await open_connection(self.url)
+            self._writer.write(command)
+            await self._writer.drain()
+            return await read_reply(self._reader)
+        except BaseException:
+            # Includes cancellation: a half-read reply would desync the next one
+            self._disconnect()
+            raise
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def close(self):
+        self._disconnect()
+
+
+class RateLimiter:
+    """
+    Leaky-bucket rate limiting for every client action.
+
+    Limits are configured per action (message, react, search, upload,
+    history, ...) and tracked per key, usually the username. State lives in
+    a store: in process memory by default, or in Redis when shared limits
+    across workers are needed.
+    """
+
+    def __init__(self, limits: Dict[str, LeakyBucket] = None, store=None):
+        """
+        :param limits: action -> LeakyBucket or TokenBucket template holding that action's limit.
+        :param store: MemoryBucketStore (default) or RedisBucketStore.
+        """
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.store = store or MemoryBucketStore()
+
+    async def check(self, action: str, key: str, amount: int = 1) -> tuple:
+        """
+        Counts one use of an action.
+        :return: (allowed, retry_after_seconds)
+        """
+        bucket = self.limits.get(action)
+        if bucket is None:
+            return True, 0.0
+        return await self.store.add(action, key, bucket, amount)
+
+    async def close(self):
+        await self.store.close()
+
+
+def create_rate_limiter(url: str = None, limits: Dict[str, LeakyBucket] = None) -> RateLimiter:
+    """Builds a rate limiter; with a redis:// URL the limits are shared between processes."""
+    store = RedisBucketStore(url) if url else MemoryBucketStore()
+    return RateLimiter(limits, store)
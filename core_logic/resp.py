@@ -0,0 +1,53 @@
+import asyncio
+from urllib.parse import urlparse
+
+# Minimal client side of the Redis serialization protocol (RESP), shared by
+# the pub/sub broker and the shared rate limit store.
+
+
+def encode_command(*args) -> bytes:
+    """Encodes a command as a RESP array of bulk strings."""
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(f"${len(data)}\r\n".encode())
+        parts.append(data)
+        parts.append(b"\r\n")
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """Parses one RESP reply."""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise ConnectionError(f"Redis error: {rest.decode()}")
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+
+async def open_connection(url: str):
+    """Opens a connection to redis://[:password@]host[:port], authenticating if needed."""
+    parsed = urlparse(url)
+    reader, writer = await asyncio.open_connection(parsed.hostname or "localhost", parsed.port or 6379)
+    if parsed.password:
+        writer.write(encode_command("AUTH", parsed.password))
+        await writer.drain()
+        await read_reply(reader)
+    return reader, writer
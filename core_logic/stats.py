@@ -0,0 +1,120 @@
+import asyncio
+from datetime import date, datetime
+from typing import Dict, List
+from .managers import ConnectionManager
+
+
+class StatsCounters:
+    """
+    Admin dashboard counters kept up to date in memory.
+
+    Seeded once from the database, then adjusted on every registration and
+    saved message, so reading them never touches SQLite. messages_today
+    rolls over to zero at local midnight. Like the history cache, changes
+    are counted locally and travel over the manager's broker so every node
+    counts every node's writes; the counts are re-read from the database
+    whenever the broker may have lost some.
+
+    Deleting a message is a soft delete that keeps its row, so it does not
+    change any of these counts (matching the original COUNT(*) queries).
+    """
+
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+        self.total_users = 0
+        self.total_messages = 0
+        self.group_messages = 0
+        self._day = date.today()
+        self._messages_today = 0
+        # Messages up to this id are already included in the seeded counts
+        self._seeded_through = 0
+        # Changes that arrive while seeding, applied once it finishes
+        self._pending: List[dict] = None
+        self._database = None
+        # Changes were lost while seeding; seed again once it finishes
+        self._reseed = False
+        manager.subscribe("stats", self._on_change)
+        manager.on_events_lost(self._on_events_lost)
+
+    async def seed(self, database):
+        """Load the starting counts from the (Async)Database."""
+        self._database = database
+        self._pending = []
+        try:
+            counts = await database.get_message_counts(self._day)
+        except BaseException:
+            self._pending = None
+            raise
+        self.total_users = counts["total_users"]
+        self.total_messages = counts["total_messages"]
+        self.group_messages = counts["group_messages"]
+        self._messages_today = counts["messages_today"]
+        self._seeded_through = counts["max_message_id"]
+
+        pending, self._pending = self._pending, None
+        for change in pending:
+            self._apply(change)
+        if self._reseed:
+            self._reseed = False
+            asyncio.ensure_future(self._resync())
+
+    def _on_events_lost(self):
+        if self._database is None:
+            return
+        if self._pending is not None:
+            self._reseed = True
+        else:
+            asyncio.ensure_future(self._resync())
+
+    async def _resync(self):
+        try:
+            await self.seed(self._database)
+        except Exception as e:
+            print(f"Stats reseed failed: {e}")
+
+    def snapshot(self) -> Dict:
+        self._roll_over()
+        return {
+            "total_users": self.total_users,
+            "total_messages": self.total_messages,
+            "messages_today": self._messages_today,
+            "group_messages": self.group_messages,
+            "private_messages": self.total_messages - self.group_messages,
+        }
+
+    def _roll_over(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._messages_today = 0
+
+    async def user_registered(self):
+        await self.manager.publish_event("stats", {"action": "user"})
+
+    async def message_saved(self, message_id: int, recipient: str, timestamp: str):
+        await self.manager.publish_event("stats", {
+            "action": "message",
+            "id": message_id,
+            "group": recipient == "GROUP",
+            "timestamp": timestamp
+        })
+
+    def _on_change(self, change: dict, frame: str):
+        if self._pending is not None:
+            self._pending.append(change)
+        else:
+            self._apply(change)
+
+    def _apply(self, change: dict):
+        if change["action"] == "user":
+            self.total_users += 1
+            return
+
+        if change["id"] <= self._seeded_through:
+            return
+        self.total_messages += 1
+        if change["group"]:
+            self.group_messages += 1
+        self._roll_over()
+        if datetime.fromisoformat(change["timestamp"]).date() == self._day:
+            self._messages_today += 1
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from typing import Dict, Set
+from .managers import ConnectionManager
+
+
+class TypingTracker:
+    """
+    Server-side typing state with batched fan-out.
+
+    Typing events only update in-memory state; repeats from a user who is
+    already typing just extend their expiry. Entries expire on their own, so
+    a lost stop_typing frame never leaves a stale indicator. Once per tick,
+    every room whose set of typers changed gets a single typing_state frame
+    with the full list of who is typing there.
+
+    State changes are shared through the manager's broker, so every node
+    keeps the same view and only delivers frames to its own connections.
+
+    Rooms are keyed by audience: 'GROUP' for the group chat, or the
+    recipient's username for direct messages.
+    """
+
+    def __init__(self, manager: ConnectionManager, ttl: float = 4.0, interval: float = 0.5):
+        """
+        :param manager: ConnectionManager used to share state and deliver typing_state frames.
+        :param ttl: Seconds a typing entry lives without being refreshed.
+        :param interval: Seconds between batched typing_state frames.
+        """
+        self.manager = manager
+        self.ttl = ttl
+        self.interval = interval
+        self._rooms: Dict[str, Dict[str, float]] = {}
+        self._dirty: Set[str] = set()
+        self._task: asyncio.Task = None
+        manager.subscribe("typing", self._on_typing)
+        manager.subscribe("typing_forget", self._on_forget)
+
+    async def start_typing(self, username: str, recipient: str):
+        """Mark a user as typing to a recipient (or 'GROUP')."""
+        expires_at = self._rooms.get(recipient, {}).get(username)
+        if expires_at is not None and expires_at - time.monotonic() > self.ttl / 2:
+            return  # Refreshed recently, nothing worth telling the other nodes
+        await self.manager.publish_event("typing", {"username": username, "recipient": recipient, "typing": True})
+
+    async def stop_typing(self, username: str, recipient: str):
+        """Clear a user's typing state for a recipient (or 'GROUP')."""
+        if username in self._rooms.get(recipient, ()):
+            await self.manager.publish_event("typing", {"username": username, "recipient": recipient, "typing": False})
+
+    async def forget(self, username: str):
+        """Drop all typing state for a user who went offline."""
+        await self.manager.publish_event("typing_forget", {"username": username})
+
+    def _on_typing(self, event: dict, frame: str):
+        username, recipient = event["username"], event["recipient"]
+        if event["typing"]:
+            typers = self._rooms.setdefault(recipient, {})
+            if username not in typers:
+                self._dirty.add(recipient)
+            typers[username] = time.monotonic() + self.ttl
+        else:
+            typers = self._rooms.get(recipient)
+            if not typers or typers.pop(username, None) is None:
+                return
+            self._dirty.add(recipient)
+            if not typers:
+                del self._rooms[recipient]
+        self._ensure_running()
+
+    def _on_forget(self, event: dict, frame: str):
+        username = event["username"]
+        self._rooms.pop(username, None)
+        self._dirty.discard(username)
+        for room, typers in list(self._rooms.items()):
+            if typers.pop(username, None) is not None:
+                self._dirty.add(room)
+                if not typers:
+                    del self._rooms[room]
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _expire(self):
+        now = time.monotonic()
+        for room, typers in list(self._rooms.items()):
+            expired = [username for username, expires_at in typers.items() if expires_at <= now]
+            for username in expired:
+                del typers[username]
+            if expired:
+                self._dirty.add(room)
+            if not typers:
+                del self._rooms[room]
+
+    async def _run(self):
+        try:
+            while self._rooms or self._dirty:
+                await asyncio.sleep(self.interval)
+                self._expire()
+                self._flush()
+        finally:
+            self._task = None
+
+    def _flush(self):
+        dirty, self._dirty = self._dirty, set()
+        for room in dirty:
+            users = sorted(self._rooms.get(room, ()))
+            if room == "GROUP":
+                self.manager.broadcast_local({
+                    "type": "typing_state",
+                    "room": "GROUP",
+                    "users": users
+                })
+            else:
+                # Everyone currently typing a direct message to this user
+                self.manager.send_local({
+                    "type": "typing_state",
+                    "room": "DIRECT",
+                    "users": users
+                }, room)
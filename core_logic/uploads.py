@@ -0,0 +1,390 @@
+import asyncio
+import gzip
+import hashlib
+import shutil
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Dict, NamedTuple, Optional
+
+try:
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Relative path of a content-addressed upload: 'ab/cd/abcd…(64 hex).ext'
+CONTENT_PATH = re.compile(r"^([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})(\.[0-9A-Za-z]{1,16})?$")
+
+# Relative path of the thumbnail generated for a content-addressed image
+THUMBNAIL_PATH = re.compile(r"^thumbs/([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})\.webp$")
+
+# Content-addressed files never change, so clients may cache them for good
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def content_hash(relative_path: str) -> Optional[str]:
+    """Returns the SHA-256 a content-addressed upload path is named after, or None."""
+    match = CONTENT_PATH.match(relative_path)
+    return match.group(3) if match else None
+
+
+def content_etag(relative_path: str) -> Optional[str]:
+    """Strong ETag for a content-addressed upload or its thumbnail, or None."""
+    sha256 = content_hash(relative_path)
+    if sha256 is not None:
+        return f'"{sha256}"'
+    match = THUMBNAIL_PATH.match(relative_path)
+    return f'"{match.group(3)}-thumb"' if match else None
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the configured size limit."""
+
+
+class InvalidUpload(Exception):
+    """Raised when an upload request is not a multipart form carrying a file."""
+
+
+class StoredUpload(NamedTuple):
+    filename: str  # Path relative to the upload directory
+    path: Path
+    size: int
+    sha256: str
+    deduplicated: bool  # An identical file was already stored
+
+
+class ReceivedUpload(NamedTuple):
+    stored: StoredUpload
+    filename: str  # As sent by the client
+    content_type: str  # Of the file part, as sent by the client
+    fields: Dict[str, str]  # The form's other fields
+
+
+class PartialUpload:
+    """
+    An upload being written. Chunks are hashed and appended to a '.partial'
+    file as they arrive; finish() moves it into place under its content hash
+    and abort() removes it. The methods block, so the store runs them on its
+    thread pool.
+    """
+
+    def __init__(self, store: "UploadStore", extension: str):
+        self._store = store
+        self._extension = extension if re.fullmatch(r"\.[0-9A-Za-z]{1,16}", extension) else ""
+        self._partial = store.directory / f"{uuid.uuid4()}{store.PARTIAL_SUFFIX}"
+        self._out: BinaryIO = None
+        self._digest = hashlib.sha256()
+        self._lock = threading.Lock()  # An abort may arrive while a write is still running
+        self._aborted = False
+        self.size = 0
+
+    def write(self, data: bytes):
+        """
+        Append a chunk.
+        :raises UploadTooLarge: Once the upload is larger than max_size.
+        """
+        with self._lock:
+            if self._aborted:
+                return
+            self.size += len(data)
+            if self.size > self._store.max_size:
+                raise UploadTooLarge(f"File is larger than {self._store.max_size // (1024 * 1024)} MB")
+            if self._out is None:
+                self._out = open(self._partial, "wb")
+            self._digest.update(data)
+            self._out.write(data)
+
+    def finish(self) -> StoredUpload:
+        """Store the completed file by content, reusing an identical one if present."""
+        store = self._store
+        with self._lock:
+            if self._out is None:
+                self._out = open(self._partial, "wb")  # Empty upload
+            self._out.close()
+            sha256 = self._digest.hexdigest()
+            filename = f"{sha256[:2]}/{sha256[2:4]}/{sha256}{self._extension}"
+            path = store.directory / filename
+            with store._files_lock:
+                deduplicated = path.exists()
+                if deduplicated:
+                    self._partial.unlink()
+                    os.utime(path)  # Restart the release grace period
+                else:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(self._partial, path)
+        if not deduplicated and self._extension.lower() in store.COMPRESSIBLE_EXTENSIONS:
+            store._write_gzip_variant(path)
+        return StoredUpload(filename, path, self.size, sha256, deduplicated)
+
+    def abort(self):
+        """Discard whatever was written so far."""
+        with self._lock:
+            self._aborted = True
+            if self._out is not None:
+                self._out.close()
+            self._partial.unlink(missing_ok=True)
+
+
+class UploadStore:
+    """
+    Writes uploaded files to disk without holding them in memory.
+
+    Each upload is written in chunks on a small thread pool as it arrives,
+    hashed as it goes, into a '.partial' file that is only renamed into
+    place once complete. Oversized or failed uploads leave nothing behind.
+    receive() parses a multipart request body straight from the socket, so
+    the size limit is enforced while receiving and the file is written once.
+
+    Files are stored by content under a sharded layout (ab/cd/<sha256>.ext),
+    so identical uploads share one file and one URL. Messages referencing a
+    file_url act as its reference count: release() deletes a file once no
+    live message points at it any more.
+    """
+
+    PARTIAL_SUFFIX = ".partial"
+    THUMBNAIL_DIR = "thumbs"
+    GZIP_SUFFIX = ".gz"
+
+    # Types that shrink well; a gzip variant is stored next to these
+    COMPRESSIBLE_EXTENSIONS = frozenset({
+        ".txt", ".csv", ".json", ".xml", ".svg", ".html", ".htm", ".md", ".log",
+        ".doc", ".xls", ".ppt", ".rtf", ".bmp", ".wav",
+    })
+
+    def __init__(self, directory: str = "uploads", max_size: int = 100 * 1024 * 1024,
+                 chunk_size: int = 1024 * 1024, max_workers: int = 4, release_grace: float = 3600.0):
+        """
+        :param directory: Where uploaded files are stored.
+        :param max_size: Largest accepted upload in bytes.
+        :param chunk_size: Bytes copied per read/write.
+        :param max_workers: Uploads written to disk concurrently.
+        :param release_grace: Seconds after its last upload during which an
+            unreferenced file is kept, so an upload whose message has not
+            been sent yet is never deleted from under it.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.release_grace = release_grace
+        # Serializes dedup hits against release() deleting the same file
+        self._files_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self._remove_partials()
+
+    def _remove_partials(self):
+        """Delete leftovers from uploads interrupted by a crash or restart."""
+        for path in self.directory.rglob(f"*{self.PARTIAL_SUFFIX}"):
+            path.unlink(missing_ok=True)
+
+    async def save(self, source: BinaryIO, extension: str = "") -> StoredUpload:
+        """
+        Stream a file-like object to a new file in the upload directory.
+        :param source: Readable binary file.
+        :param extension: Suffix for the stored filename, including the dot.
+        :raises UploadTooLarge: If the source is larger than max_size.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._write, source, extension)
+
+    def _write(self, source: BinaryIO, extension: str) -> StoredUpload:
+        upload = PartialUpload(self, extension)
+        try:
+            while True:
+                chunk = source.read(self.chunk_size)
+                if not chunk:
+                    break
+                upload.write(chunk)
+            return upload.finish()
+        except BaseException:
+            upload.abort()
+            raise
+
+    async def receive(self, body: AsyncIterator[bytes], content_type: str, file_field: str = "file",
+                      max_field_size: int = 1024) -> ReceivedUpload:
+        """
+        Parse a multipart/form-data body as it arrives, writing its file part
+        straight to the upload directory.
+        :param body: The raw request body (e.g. Request.stream()).
+        :param content_type: The request's Content-Type header.
+        :param file_field: Form field holding the file; other file parts are skipped.
+        :param max_field_size: Largest accepted value of any other field, in bytes.
+        :raises UploadTooLarge: As soon as the file passes max_size.
+        :raises InvalidUpload: If the body is not a form with a file in file_field.
+        """
+        media_type, options = parse_options_header(content_type or "")
+        boundary = options.get(b"boundary")
+        if media_type != b"multipart/form-data" or not boundary:
+            raise InvalidUpload("Expected a multipart/form-data body")
+
+        loop = asyncio.get_running_loop()
+        upload: PartialUpload = None
+        file_info = {}
+        fields: Dict[str, str] = {}
+        pending = []  # File data parsed but not yet written
+        part = {"headers": {}, "field": b"", "value": b"", "data": b"", "kind": None, "name": None}
+        # Form overhead (boundaries, headers, small fields) allowed on top of the file
+        limit = self.max_size + 64 * 1024
+        received = 0
+
+        def on_part_begin():
+            part.update(headers={}, field=b"", value=b"", data=b"", kind=None, name=None)
+
+        def on_header_field(data, start, end):
+            part["field"] += data[start:end]
+
+        def on_header_value(data, start, end):
+            part["value"] += data[start:end]
+
+        def on_header_end():
+            part["headers"][part["field"].lower()] = part["value"]
+            part["field"], part["value"] = b"", b""
+
+        def on_headers_finished():
+            nonlocal upload
+            _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+            name = disposition.get(b"name", b"").decode("utf-8", "replace")
+            filename = disposition.get(b"filename")
+            part["name"] = name
+            if filename is None:
+                part["kind"] = "field"
+            elif name == file_field and upload is None:
+                file_info["filename"] = filename.decode("utf-8", "replace")
+                file_info["content_type"] = part["headers"].get(b"content-type", b"").decode("latin-1")
+                upload = PartialUpload(self, Path(file_info["filename"]).suffix.lower())
+                part["kind"] = "file"
+            else:
+                part["kind"] = "skip"
+
+        def on_part_data(data, start, end):
+            if part["kind"] == "file":
+                pending.append(bytes(data[start:end]))
+            elif part["kind"] == "field":
+                part["data"] += data[start:end]
+                if len(part["data"]) > max_field_size:
+                    raise InvalidUpload(f"Form field {part['name']!r} is too long")
+
+        def on_part_end():
+            if part["kind"] == "field":
+                fields[part["name"]] = part["data"].decode("utf-8", "replace")
+
+        parser = MultipartParser(boundary, {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        })
+
+        async def flush():
+            data = b"".join(pending)
+            pending.clear()
+            await loop.run_in_executor(self._executor, upload.write, data)
+
+        try:
+            async for chunk in body:
+                received += len(chunk)
+                if received > limit:
+                    raise UploadTooLarge(f"File is larger than {self.max_size // (1024 * 1024)} MB")
+                try:
+                    parser.write(chunk)
+                except FormParserError as e:
+                    raise InvalidUpload(f"Malformed multipart body: {e}")
+                # Batch the small network reads into chunk_size writes
+                if sum(map(len, pending)) >= self.chunk_size:
+                    await flush()
+            parser.finalize()
+            if upload is None:
+                raise InvalidUpload(f"No file in form field {file_field!r}")
+            if pending:
+                await flush()
+            stored = await loop.run_in_executor(self._executor, upload.finish)
+        except BaseException:
+            if upload is not None:
+                # Not awaited, so a cancelled request cleans up too
+                self._executor.submit(upload.abort)
+            raise
+        return ReceivedUpload(stored, file_info["filename"], file_info["content_type"], fields)
+
+    def _write_gzip_variant(self, path: Path):
+        """Store a precompressed copy to serve to clients accepting gzip, if it is worth it."""
+        variant = path.with_name(path.name + self.GZIP_SUFFIX)
+        partial = path.with_name(path.name + self.GZIP_SUFFIX + self.PARTIAL_SUFFIX)
+        try:
+            with open(path, "rb") as source, open(partial, "wb") as raw:
+                # mtime=0 keeps the variant byte-identical for identical content
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=9, mtime=0) as out:
+                    shutil.copyfileobj(source, out, self.chunk_size)
+            if partial.stat().st_size < path.stat().st_size * 0.9:
+                os.replace(partial, variant)
+        finally:
+            partial.unlink(missing_ok=True)
+
+    def path_for_url(self, file_url: str, prefix: str = "/uploads/") -> Optional[Path]:
+        """Maps a content-addressed file_url to its path on disk (None for anything else)."""
+        if not file_url or not file_url.startswith(prefix):
+            return None
+        relative = file_url[len(prefix):]
+        if content_hash(relative) is None:
+            return None
+        return self.directory / relative
+
+    def url_for(self, path: Path, prefix: str = "/uploads/") -> str:
+        """The URL a file in the upload directory is served at."""
+        return prefix + path.relative_to(self.directory).as_posix()
+
+    def thumbnail_path(self, path: Path) -> Path:
+        """Where the thumbnail of a content-addressed image is stored."""
+        sha256 = path.name.split(".", 1)[0]
+        return self.directory / self.THUMBNAIL_DIR / sha256[:2] / sha256[2:4] / f"{sha256}.webp"
+
+    async def release(self, file_url: str) -> bool:
+        """
+        Delete a content-addressed file that no live message references any more.
+        Files uploaded within the grace period, and anything that is not a
+        content-addressed upload, are left alone.
+        :return: True if the file was deleted.
+        """
+        path = self.path_for_url(file_url)
+        if path is None:
+            return False
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._release, path)
+
+    def _release(self, path: Path) -> bool:
+        with self._files_lock:
+            try:
+                if time.time() - path.stat().st_mtime < self.release_grace:
+                    return False
+                path.unlink()
+            except FileNotFoundError:
+                return False
+            path.with_name(path.name + self.GZIP_SUFFIX).unlink(missing_ok=True)
+            self._remove_with_shards(path)
+            thumbnail = self.thumbnail_path(path)
+            if thumbnail.exists():
+                thumbnail.unlink()
+                self._remove_with_shards(thumbnail)
+        return True
+
+    @staticmethod
+    def _remove_with_shards(path: Path):
+        """Remove the now empty shard directories above a deleted file."""
+        for shard in (path.parent, path.parent.parent):
+            try:
+                shard.rmdir()
+            except OSError:
+                break  # Not empty
+
+    def close(self):
+        """Wait for in-flight uploads to finish writing."""
+        self._executor.shutdown(wait=True)
+
@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from .database import Database
+
+
+class WriteBatcher:
+    """
+    Group-commit stage for small, frequent writes.
+
+    Writes submitted within a short window are executed back to back on the
+    writer connection and committed as one transaction, so a burst of chat
+    messages costs one WAL sync instead of one per message. Each write runs
+    inside its own savepoint, so a failing write only affects its own caller.
+    """
+
+    def __init__(self, database: Database, max_delay: float = 0.005, max_batch: int = 256):
+        """
+        :param database: The Database whose writer connection is used.
+        :param max_delay: Seconds to wait for more writes after the first one arrives.
+        :param max_batch: Maximum number of writes committed together.
+        """
+        self.database = database
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """Queue a write; the returned future resolves once its batch commits."""
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def _collect(self) -> list:
+        """Block for the first write, then gather more until the window closes."""
+        first = self._queue.get()
+        if first is None:
+            return [None]
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self._execute(batch)
+            if stopping:
+                return
+
+    def _execute(self, batch: list):
+        results = []
+        try:
+            with self.database._write() as conn:
+                conn.execute("BEGIN")
+                for future, func, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute("SAVEPOINT batched_write")
+                    try:
+                        result = func(*args, **kwargs)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO batched_write")
+                        conn.execute("RELEASE batched_write")
+                        results.append((future, None, e))
+                    else:
+                        conn.execute("RELEASE batched_write")
+                        results.append((future, result, None))
+        except Exception as e:
+            # The commit itself failed, so none of the writes landed
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Flush pending writes and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
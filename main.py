@@ -1,74 +1,159 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, File, UploadFile
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict
 from datetime import datetime, timedelta
-from core_logic.leaky_bucket import LeakyBucket
+from core_logic.managers import ConnectionManager, LogManager
+from core_logic.brokers import create_broker
+from core_logic.typing_tracker import TypingTracker
+from core_logic.rate_limiter import RateLimiter, create_rate_limiter
 from core_logic.database import Database
+from core_logic.async_database import AsyncDatabase
+from core_logic.uploads import UploadStore, UploadTooLarge, InvalidUpload
+from core_logic.file_serving import UploadFiles, accepts_gzip
+from core_logic.media import MediaPipeline
+from core_logic.history_cache import HistoryCache, conversation_key
+from core_logic.stats import StatsCounters
+from core_logic.export import MessageExport
+from core_logic.passwords import PasswordHasher, PasswordHasherBusy
+from contextlib import asynccontextmanager
+import functools
+import math
 import os
 
-app = FastAPI()
-
-# Mount uploads directory for serving files
-os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-
-# Database instance
-db = Database("chat_history.db")
-
-# Active connections
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_buckets: Dict[str, LeakyBucket] = {}
-
-    async def connect(self, username: str, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[username] = websocket
-        self.user_buckets[username] = LeakyBucket(capacity=5, leak_rate=1.0)
-        await self.broadcast_user_list()
-
-    def disconnect(self, username: str):
-        if username in self.active_connections:
-            del self.active_connections[username]
-        if username in self.user_buckets:
-            del self.user_buckets[username]
-
-    async def send_personal_message(self, message: dict, username: str):
-        if username in self.active_connections:
-            await self.active_connections[username].send_json(message)
-
-    async def broadcast(self, message: dict, exclude: str = None):
-        for username, connection in self.active_connections.items():
-            if username != exclude:
-                await connection.send_json(message)
-
-    async def broadcast_user_list(self):
-        users = list(self.active_connections.keys())
-        connections = list(self.active_connections.values())
-        for connection in connections:
-            try:
-                await connection.send_json({
-                    "type": "user_list",
-                    "users": users
-                })
-            except:
-                pass
+UPLOAD_DIR = "uploads"
 
-    def check_rate_limit(self, username: str) -> tuple:
-        if username not in self.user_buckets:
-            return True, ""
-        
-        bucket = self.user_buckets[username]
-        if bucket.add_message():
-            return True, ""
-        else:
-            wait_time = int((bucket._current_level - bucket.capacity) / bucket.leak_rate) + 1
-            return False, f"Slow down! Please wait {wait_time} seconds before sending another message."
+# Shared services, built by create_services() when the app starts rather than
+# on import: thumbnail and password workers re-import this module when they
+# start, and must not open their own database, pools or broker connection
+upload_store: UploadStore = None
+db: AsyncDatabase = None
+manager: ConnectionManager = None
+typing_tracker: TypingTracker = None
+history_cache: HistoryCache = None
+stats: StatsCounters = None
+media_pipeline: MediaPipeline = None
+password_hasher: PasswordHasher = None
+rate_limiter: RateLimiter = None
+log_manager: LogManager = None
+
+
+def create_services():
+    """Create the database, backplane, caches, worker pools and rate limiter."""
+    global upload_store, db, manager, typing_tracker, history_cache, stats
+    global media_pipeline, password_hasher, rate_limiter, log_manager
+
+    # Uploads are streamed to disk; MKCHAT_MAX_UPLOAD_MB caps their size (default 100)
+    upload_store = UploadStore(UPLOAD_DIR, max_size=int(os.environ.get("MKCHAT_MAX_UPLOAD_MB", "100")) * 1024 * 1024)
+
+    # Database instance (queries run off the event loop)
+    db = AsyncDatabase(Database("chat_history.db"))
+
+    # Active connections
+    # Set MKCHAT_BROKER_URL (e.g. redis://localhost:6379) to share events between workers
+    manager = ConnectionManager(broker=create_broker(os.environ.get("MKCHAT_BROKER_URL")))
+    typing_tracker = TypingTracker(manager)
+
+    # Recent history per conversation, served from memory
+    history_cache = HistoryCache(manager)
+
+    # Admin dashboard counters, maintained incrementally
+    stats = StatsCounters(manager)
 
+    # Thumbnails and blur placeholders for image attachments (needs Pillow)
+    media_pipeline = MediaPipeline(upload_store, db, on_preview=history_cache.preview_ready)
 
-manager = ConnectionManager()
+    # Salted scrypt password hashing in worker processes
+    password_hasher = PasswordHasher(db)
+
+    # Per-action rate limits; set MKCHAT_RATE_LIMIT_URL (defaults to the broker URL)
+    # to a Redis-compatible server to enforce them across workers
+    rate_limiter = create_rate_limiter(os.environ.get("MKCHAT_RATE_LIMIT_URL", os.environ.get("MKCHAT_BROKER_URL")))
+
+    # Live admin dashboard updates, pushed as they happen
+    log_manager = LogManager(manager, admin_stats)
+
+
+def admin_stats() -> dict:
+    """System statistics for the admin dashboard (all in memory)."""
+    counts = stats.snapshot()
+    return {
+        "total_users": counts["total_users"],
+        "online_users": len(manager.get_online_users()),
+        "total_messages": counts["total_messages"],
+        "messages_today": counts["messages_today"],
+        "group_messages": counts["group_messages"],
+        "private_messages": counts["private_messages"],
+        "media_queue_depth": media_pipeline.queue_depth,
+        "history_cache": history_cache.stats()
+    }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create and start the services; on shutdown, stop everything in reverse order."""
+    create_services()
+    await manager.start()
+    await stats.seed(db)
+    yield
+    # Tell other nodes our users are gone while the broker is still up
+    await manager.close()
+    await rate_limiter.close()
+    # Finish background work that still writes files or rows
+    media_pipeline.close()
+    password_hasher.close()
+    upload_store.close()
+    # Last: flush batched writes and close the connection pool
+    db.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Mount uploads directory for serving files (ranges, conditional GETs, immutable caching);
+# the directory is checked on the first request, once the upload store has created it
+app.mount("/uploads", UploadFiles(directory=UPLOAD_DIR, check_dir=False), name="uploads")
+
+# Limited action -> what the user is told to wait before doing
+RATE_LIMIT_WARNINGS = {
+    "message": "sending another message",
+    "react": "reacting again",
+    "search": "searching again",
+    "upload": "uploading another file",
+    "history": "loading more history",
+}
+
+# WebSocket frame type -> rate-limited action
+RATE_LIMITED_FRAMES = {
+    "message": "message",
+    "react": "react",
+    "search": "search",
+    "get_history": "history",
+}
+
+
+async def check_rate_limit(action: str, key: str) -> tuple:
+    """Counts one use of an action; returns (allowed, warning)."""
+    allowed, retry_after = await rate_limiter.check(action, key)
+    if allowed:
+        return True, ""
+    wait_time = max(1, math.ceil(retry_after))
+    return False, f"Slow down! Please wait {wait_time} seconds before {RATE_LIMIT_WARNINGS[action]}."
+
+
+def rate_limit_key(request: Request) -> str:
+    """
+    Who an HTTP request is counted against: its client address. The username
+    parameters are not checked against anything, so counting by them would
+    let a client dodge its limits or use up someone else's. Behind a tunnel
+    every peer is 127.0.0.1 unless the tunnel sets X-Forwarded-For, and
+    request.client is None on some transports.
+    """
+    return request.client.host if request.client else "unknown"
+
+# Maximum number of messages returned per get_history request
+HISTORY_PAGE_SIZE = 100
+
+# Maximum number of users returned per /api/admin/users page
+ADMIN_USERS_PAGE_SIZE = 200
 
 
 # Models
@@ -92,8 +177,12 @@ async def register(user: UserRegister):
     if len(user.password) < 4:
         raise HTTPException(status_code=400, detail="Password must be at least 4 characters")
     
-    success = db.create_user(user.username, user.password)
+    try:
+        success = await password_hasher.register(user.username, user.password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, please try again", headers={"Retry-After": "1"})
     if success:
+        await stats.user_registered()
         return {"message": "User registered successfully"}
     else:
         raise HTTPException(status_code=400, detail="Username already exists")
@@ -102,7 +191,11 @@ async def register(user: UserRegister):
 @app.post("/api/login")
 async def login(user: UserLogin):
     """Login user."""
-    if db.verify_user(user.username, user.password):
+    try:
+        valid = await password_hasher.verify(user.username, user.password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, please try again", headers={"Retry-After": "1"})
+    if valid:
         return {"message": "Login successful", "username": user.username}
     else:
         raise HTTPException(status_code=401, detail="Invalid username or password")
@@ -126,68 +219,96 @@ async def get_admin_page():
 @app.get("/api/admin/stats")
 async def get_admin_stats():
     """Get system statistics for admin dashboard."""
-    total_users = db.get_total_users()
-    online_users = len(manager.active_connections)
-    total_messages = db.get_total_messages()
-    messages_today = db.get_messages_today()
-    group_messages = db.get_group_message_count()
-    private_messages = total_messages - group_messages
-    
-    return {
-        "total_users": total_users,
-        "online_users": online_users,
-        "total_messages": total_messages,
-        "messages_today": messages_today,
-        "group_messages": group_messages,
-        "private_messages": private_messages
-    }
+    return admin_stats()
 
 
 # Admin API - Get All Users
 @app.get("/api/admin/users")
-async def get_all_users():
-    """Get all registered users with their stats."""
-    users = db.get_all_users_with_stats()
+async def get_all_users(sort: str = "message_count", order: str = "desc", limit: int = 50, offset: int = 0):
+    """Get one page of registered users with their stats."""
+    if sort not in Database.USER_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {sort}")
+    limit = max(1, min(limit, ADMIN_USERS_PAGE_SIZE))
+    offset = max(0, offset)
+    users = await db.get_all_users_with_stats(sort, order != "asc", limit, offset)
     
     # Add online status
     for user in users:
-        user['is_online'] = user['username'] in manager.active_connections
+        user['is_online'] = manager.is_online(user['username'])
     
-    return users
+    return {
+        "users": users,
+        "total": stats.snapshot()["total_users"],
+        "sort": sort,
+        "order": "asc" if order == "asc" else "desc",
+        "limit": limit,
+        "offset": offset
+    }
 
 
 # Admin API - Get All Messages
 @app.get("/api/admin/messages")
 async def get_all_messages():
     """Get all messages from the system."""
-    return db.get_all_messages()
+    return await db.get_all_messages()
+
+
+# Admin API - Export Messages
+@app.get("/api/admin/messages/export")
+async def export_messages(request: Request, format: str = "ndjson", since: str = None, until: str = None,
+                          sender: str = None, recipient: str = None):
+    """Stream every message matching the filters as NDJSON or CSV (gzipped if the client accepts it)."""
+    if format not in MessageExport.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}")
+    try:
+        # Normalise to the form timestamps are stored in, so they compare as text
+        since = datetime.fromisoformat(since).isoformat() if since else None
+        until = datetime.fromisoformat(until).isoformat() if until else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since/until must be ISO 8601 dates")
+
+    compress = accepts_gzip(request.headers.get("accept-encoding"))
+    export = MessageExport(db, format, compress, since=since, until=until,
+                           sender=sender or None, recipient=recipient or None)
+    headers = {"content-disposition": f'attachment; filename="{export.filename}"', "vary": "Accept-Encoding"}
+    if compress:
+        headers["content-encoding"] = "gzip"
+    return StreamingResponse(export, media_type=export.media_type, headers=headers)
 
 
 # Enhanced API Endpoints
 @app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...)):
-    """Upload a file or image."""
-    import os
-    import uuid
+async def upload_file(request: Request, username: str = None):
+    """
+    Upload a file or image as multipart form field 'file'. The body is parsed
+    as it arrives and written straight to disk, so nothing is read before the
+    checks below and an oversized upload is cut off as soon as it passes the
+    limit. The username goes in the query string (or, from older clients,
+    a form field) and is only used for the upload statistics.
+    """
+    # Reject obviously oversized uploads before reading any of the body
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > upload_store.max_size + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"File is larger than {upload_store.max_size // (1024 * 1024)} MB")
+
+    allowed, warning = await check_rate_limit("upload", rate_limit_key(request))
+    if not allowed:
+        raise HTTPException(status_code=429, detail=warning)
+
     from pathlib import Path
-    
-    # Create uploads directory if it doesn't exist
-    uploads_dir = Path("uploads")
-    uploads_dir.mkdir(exist_ok=True)
-    
-    # Generate unique filename
-    file_extension = Path(file.filename).suffix.lower()
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = uploads_dir / unique_filename
-    
-    # Save file
+
+    # Save file (hashed and written in chunks as it is received, stored by content hash)
     try:
-        contents = await file.read()
-        with open(file_path, "wb") as f:
-            f.write(contents)
+        received = await upload_store.receive(request.stream(), request.headers.get("content-type"))
+        stored = received.stored
+        file_extension = Path(received.filename).suffix.lower()
+        # Older clients send the username as a form field
+        username = username or received.fields.get("username")
+        if username:
+            await db.add_uploaded_bytes(username, stored.size)
         
         # Determine file type
-        if file.content_type and file.content_type.startswith("image/"):
+        if received.content_type.startswith("image/"):
             file_type = "image"
         elif file_extension in ['.pdf']:
             file_type = "pdf"
@@ -207,26 +328,34 @@ async def upload_file(file: UploadFile = File(...)):
             file_type = "file"
         
         return {
-            "file_url": f"/uploads/{unique_filename}",
+            "file_url": f"/uploads/{stored.filename}",
             "file_type": file_type,
-            "filename": file.filename,
-            "size": len(contents)
+            "filename": received.filename,
+            "size": stored.size
         }
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/api/search")
-async def search_messages_api(q: str, username: str = None):
+async def search_messages_api(request: Request, q: str, username: str = None):
     """Search messages."""
-    results = db.search_messages(q, username)
+    allowed, warning = await check_rate_limit("search", rate_limit_key(request))
+    if not allowed:
+        raise HTTPException(status_code=429, detail=warning)
+
+    results = await db.search_messages(q, username)
     return {"results": results}
 
 
 @app.get("/api/user/{username}")
 async def get_user_info_api(username: str):
     """Get user information."""
-    user_info = db.get_user_info(username)
+    user_info = await db.get_user_info(username)
     if user_info:
         return user_info
     raise HTTPException(status_code=404, detail="User not found")
@@ -235,21 +364,35 @@ async def get_user_info_api(username: str):
 @app.get("/api/users/all")
 async def get_all_users_api():
     """Get all registered users."""
-    users = db.get_all_users()
+    users = await db.get_all_users()
     return {"users": users}
-    user_info = db.get_user_info(username)
+    user_info = await db.get_user_info(username)
     if user_info:
         return user_info
     else:
         raise HTTPException(status_code=404, detail="User not found")
 
 
+@app.websocket("/admin/ws")
+async def admin_websocket(websocket: WebSocket):
+    """Live updates for the admin dashboard."""
+    await log_manager.connect(websocket)
+    try:
+        while True:
+            await websocket.receive_text()  # Nothing is expected; wait for the close
+    except WebSocketDisconnect:
+        log_manager.disconnect(websocket)
+    except Exception as e:
+        print(f"Error: {e}")
+        log_manager.disconnect(websocket)
+
+
 @app.websocket("/ws/{username}")
 async def websocket_endpoint(websocket: WebSocket, username: str):
     """WebSocket connection for real-time chat."""
     
     # Verify user exists in database
-    if not db.user_exists(username):
+    if not await db.user_exists(username):
         await websocket.close(code=1008, reason="User not found")
         return
     
@@ -260,64 +403,73 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
             data = await websocket.receive_json()
             message_type = data.get("type")
 
+            action = RATE_LIMITED_FRAMES.get(message_type)
+            if message_type == "get_history" and not data.get("before_id"):
+                # Only paging back is limited: dropping the first page of a
+                # conversation or a catch-up after reconnecting would leave the
+                # client showing the wrong conversation or missing messages
+                action = None
+            if action:
+                can_send, warning = await check_rate_limit(action, username)
+                if not can_send:
+                    manager.send_to_connection(websocket, {
+                        "type": "warning",
+                        "action": action,
+                        "message": warning
+                    })
+                    continue
+
             if message_type == "get_history":
-                # Get message history
+                # Get one page of message history.
+                # before_id pages backwards into older messages,
+                # after_id returns only messages newer than the client already has.
                 recipient = data.get("recipient", "GROUP")
+                before_id = data.get("before_id")
+                after_id = data.get("after_id")
+                try:
+                    limit = max(1, min(int(data.get("limit") or HISTORY_PAGE_SIZE), HISTORY_PAGE_SIZE))
+                except (TypeError, ValueError):
+                    limit = HISTORY_PAGE_SIZE  # Not a number; fall back instead of dropping the socket
                 if recipient == "GROUP":
-                    messages = db.get_group_messages_enhanced()
+                    load = db.get_group_messages_enhanced
                 else:
-                    messages = db.get_private_messages_enhanced(username, recipient)
+                    load = functools.partial(db.get_private_messages_enhanced, username, recipient)
+                messages = await history_cache.get_page(
+                    conversation_key(username, recipient), limit, before_id, after_id, load=load
+                )
                 
-                await manager.send_personal_message({
+                manager.send_to_connection(websocket, {
                     "type": "history",
+                    "recipient": recipient,
+                    "before_id": before_id,
+                    "after_id": after_id,
+                    "has_more": len(messages) == limit,
                     "messages": messages
-                }, username)
+                })
 
             elif message_type == "typing":
-                # Broadcast typing indicator
-                recipient = data.get("recipient", "GROUP")
-                if recipient == "GROUP":
-                    await manager.broadcast({
-                        "type": "user_typing",
-                        "username": username,
-                        "recipient": "GROUP"
-                    }, exclude=username)
-                else:
-                    # Send to the other person that 'username' is typing to them
-                    await manager.send_personal_message({
-                        "type": "user_typing",
-                        "username": username,
-                        "recipient": username  # This indicates who is typing (the sender)
-                    }, recipient)
+                # Record typing state; fan-out is batched by the tracker
+                await typing_tracker.start_typing(username, data.get("recipient", "GROUP"))
 
             elif message_type == "stop_typing":
-                # Broadcast stop typing
-                recipient = data.get("recipient", "GROUP")
-                if recipient == "GROUP":
-                    await manager.broadcast({
-                        "type": "user_stop_typing",
-                        "username": username,
-                        "recipient": "GROUP"
-                    }, exclude=username)
-                else:
-                    await manager.send_personal_message({
-                        "type": "user_stop_typing",
-                        "username": username,
-                        "recipient": username  # This indicates who stopped typing (the sender)
-                    }, recipient)
+                await typing_tracker.stop_typing(username, data.get("recipient", "GROUP"))
 
             elif message_type == "react":
                 # Add reaction to message
                 message_id = data.get("message_id")
                 emoji = data.get("emoji")
                 if message_id and emoji:
-                    db.add_reaction(message_id, username, emoji)
-                    # Broadcast reaction update
+                    added = await db.add_reaction(message_id, username, emoji)
+                    reactions = await db.get_message_reactions(message_id)
+                    await history_cache.reactions_changed(message_id, reactions)
+                    # Broadcast the full reaction state so clients can patch in place
                     await manager.broadcast({
                         "type": "reaction_update",
                         "message_id": message_id,
                         "emoji": emoji,
-                        "username": username
+                        "username": username,
+                        "added": added,
+                        "reactions": reactions
                     })
 
             elif message_type == "edit":
@@ -325,7 +477,8 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                 message_id = data.get("message_id")
                 new_text = data.get("new_text", "").strip()
                 if message_id and new_text:
-                    db.update_message(message_id, new_text)
+                    await db.update_message(message_id, new_text)
+                    await history_cache.message_edited(message_id, new_text)
                     await manager.broadcast({
                         "type": "message_edited",
                         "message_id": message_id,
@@ -337,7 +490,10 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                 # Delete message
                 message_id = data.get("message_id")
                 if message_id:
-                    db.delete_message(message_id)
+                    orphaned_file = await db.delete_message(message_id)
+                    await history_cache.message_deleted(message_id)
+                    if orphaned_file:
+                        await upload_store.release(orphaned_file)
                     await manager.broadcast({
                         "type": "message_deleted",
                         "message_id": message_id
@@ -347,17 +503,17 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                 # Search messages
                 query = data.get("query", "").strip()
                 if query:
-                    results = db.search_messages(query, username)
-                    await manager.send_personal_message({
+                    results = await db.search_messages(query, username)
+                    manager.send_to_connection(websocket, {
                         "type": "search_results",
                         "results": results
-                    }, username)
+                    })
 
             elif message_type == "status_change":
                 # Update user status
                 status = data.get("status", "online")
                 status_message = data.get("status_message", "")
-                db.update_user_status(username, status, status_message)
+                await db.update_user_status(username, status, status_message)
                 await manager.broadcast({
                     "type": "user_status_changed",
                     "username": username,
@@ -366,16 +522,6 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                 })
 
             elif message_type == "message":
-                # Check rate limit
-                can_send, warning = manager.check_rate_limit(username)
-                
-                if not can_send:
-                    await manager.send_personal_message({
-                        "type": "warning",
-                        "message": warning
-                    }, username)
-                    continue
-
                 # Process message
                 message_text = data.get("message", "").strip()
                 recipient = data.get("recipient", "GROUP")
@@ -388,7 +534,24 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
 
                 # Save message to database and get ID
                 timestamp = datetime.now().isoformat()
-                message_id = db.save_message_with_id(username, recipient, message_text, timestamp, reply_to, file_url, file_type)
+                message_id = await db.save_message_with_id(username, recipient, message_text, timestamp, reply_to, file_url, file_type)
+                await stats.message_saved(message_id, recipient, timestamp)
+                await history_cache.message_saved(conversation_key(username, recipient), {
+                    "id": message_id,
+                    "sender": username,
+                    "message": message_text,
+                    "timestamp": timestamp,
+                    "edited": False,
+                    "deleted": False,
+                    "reply_to": reply_to,
+                    "file_url": file_url,
+                    "file_type": file_type,
+                    "thumbnail_url": None,
+                    "placeholder": None,
+                    "reactions": []
+                })
+                if file_url and file_type == "image":
+                    media_pipeline.submit(file_url)
 
                 # Prepare message payload
                 message_payload = {
@@ -415,11 +578,12 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                     await manager.send_personal_message(message_payload, username)
 
     except WebSocketDisconnect:
-        manager.disconnect(username)
-        await manager.broadcast_user_list()
+        if manager.disconnect(username, websocket):
+            await typing_tracker.forget(username)
     except Exception as e:
         print(f"Error: {e}")
-        manager.disconnect(username)
+        if manager.disconnect(username, websocket):
+            await typing_tracker.forget(username)
 
 
 if __name__ == "__main__":
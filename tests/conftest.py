@@ -0,0 +1,71 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# Make the repository root importable when running pytest from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core_logic.database import ConnectionPool, Database  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A fresh, fully migrated Database in a temporary directory."""
+    db = Database(str(tmp_path / "chat.db"))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def statements(tmp_path, monkeypatch):
+    """
+    (database, executed) where executed collects every SQL statement
+    the database's pooled connections run.
+    """
+    executed = []
+    connect = ConnectionPool._connect
+
+    def traced_connect(self):
+        conn = connect(self)
+        conn.set_trace_callback(executed.append)
+        return conn
+
+    monkeypatch.setattr(ConnectionPool, "_connect", traced_connect)
+    db = Database(str(tmp_path / "chat.db"))
+    yield db, executed
+    db.close()
+
+
+class FakeRedisServer:
+    """A Redis stand-in (fakeredis, with Lua) on a local port that tests can stop and restart."""
+
+    def __init__(self, tcp_server_class):
+        self._server_class = tcp_server_class
+        self._server = None
+        self.port = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.port}"
+
+    def start(self):
+        self._server = self._server_class(("127.0.0.1", self.port or 0))
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Shut the server down and drop every client connection."""
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def redis_server():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = FakeRedisServer(fakeredis.TcpFakeServer)
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,157 @@
+"""
+The broker backplane survives Redis outages, presence does not outlive a
+node that stopped sending heartbeats, and state built from broker events
+recovers from events the broker lost.
+"""
+
+import asyncio
+import json
+
+from core_logic.async_database import AsyncDatabase
+from core_logic.brokers import Broker, InProcessBroker, RedisBroker
+from core_logic.history_cache import HistoryCache
+from core_logic.managers import ConnectionManager
+from core_logic.stats import StatsCounters
+
+
+class FlakyBroker(Broker):
+    """Delivers payloads like InProcessBroker until told to drop them."""
+
+    def __init__(self):
+        super().__init__()
+        self.down = False
+
+    async def publish(self, payload: str):
+        if self.down:
+            self._lost()
+        else:
+            self._dispatch(payload)
+
+
+async def _wait_for(condition, timeout: float = 5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+def test_redis_broker_reconnects_after_outage(redis_server):
+    async def scenario():
+        broker = RedisBroker(redis_server.url, retry_delay=0.05, max_retry_delay=0.2)
+        received = []
+        broker.subscribe(received.append)
+        await broker.start()
+        try:
+            await broker.publish("before")
+            await _wait_for(lambda: "before" in received)
+
+            redis_server.stop()
+            await asyncio.sleep(0.3)
+            await broker.publish("during")  # Logged and dropped, not raised
+            redis_server.start()
+
+            # Resubscribing happens in the background; keep publishing until it is back
+            async def delivered():
+                await broker.publish("after")
+                await asyncio.sleep(0.05)
+                return "after" in received
+            deadline = asyncio.get_running_loop().time() + 5
+            while not await delivered():
+                assert asyncio.get_running_loop().time() < deadline, "broker never recovered"
+        finally:
+            await broker.close()
+
+    asyncio.run(scenario())
+
+
+def test_silent_node_expires():
+    async def scenario():
+        manager = ConnectionManager(broker=InProcessBroker(), heartbeat_interval=0.05, node_ttl=0.2)
+        frames = []
+        manager._broadcast_frame = lambda frame, exclude=None: frames.append(json.loads(frame))
+        await manager.start()
+        try:
+            await manager.broker.publish(json.dumps({"op": "presence", "node": "other", "joined": ["bob"], "left": []}) + "\n")
+            assert manager.is_online("bob")
+
+            await _wait_for(lambda: not manager.is_online("bob"))
+            assert frames[-1] == {"type": "presence", "joined": [], "left": ["bob"]}
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_heartbeat_repairs_missed_deltas():
+    async def scenario():
+        manager = ConnectionManager(broker=InProcessBroker(), heartbeat_interval=60)
+        manager._broadcast_frame = lambda frame, exclude=None: None
+        await manager.start()
+        try:
+            publish = manager.broker.publish
+            await publish(json.dumps({"op": "presence", "node": "other", "joined": ["bob"], "left": []}) + "\n")
+            # bob's "left" and carol's "joined" were lost; the next heartbeat corrects both
+            await publish(json.dumps({"op": "heartbeat", "node": "other", "users": ["carol"]}) + "\n")
+            assert sorted(manager.get_online_users()) == ["carol"]
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_local_writes_do_not_depend_on_the_broker(database):
+    async def scenario():
+        db = AsyncDatabase(database)
+        broker = FlakyBroker()
+        manager = ConnectionManager(broker=broker)
+        cache = HistoryCache(manager)
+        stats = StatsCounters(manager)
+        try:
+            await stats.seed(db)
+            load = db.get_group_messages_enhanced
+            first = await db.save_message_with_id("alice", "GROUP", "one", "2024-01-01T00:00:00")
+            await cache.get_page("GROUP", 10, load=load)  # Fill
+
+            # Applied here even though the broker drops it; then the cache is
+            # dropped, as other nodes' changes may have been lost too
+            broker.down = True
+            await cache.message_edited(first, "edited")
+            await stats.message_saved(first, "GROUP", "2024-01-01T00:00:00")
+            assert cache.stats()["conversations"] == 0
+            assert await cache.get_page("GROUP", 10, load=load) == await load(10, None, None)
+
+            # A message another node saved while the broker was down: only a reseed sees it
+            broker.down = False
+            await db.save_message_with_id("bob", "GROUP", "two", "2024-01-01T00:00:01")
+            broker._lost()
+            await asyncio.sleep(0.1)
+            assert stats.snapshot()["total_messages"] == 2
+            assert stats.snapshot()["group_messages"] == 2
+        finally:
+            db.close()
+
+    asyncio.run(scenario())
+
+
+def test_own_events_are_not_applied_twice(database):
+    async def scenario():
+        db = AsyncDatabase(database)
+        manager = ConnectionManager(broker=InProcessBroker())
+        stats = StatsCounters(manager)
+        try:
+            await stats.seed(db)
+            message_id = await db.save_message_with_id("alice", "GROUP", "one", "2024-01-01T00:00:00")
+            await stats.message_saved(message_id, "GROUP", "2024-01-01T00:00:00")
+            assert stats.snapshot()["total_messages"] == 1
+
+            # Changes from other nodes still arrive through the broker
+            await manager.broker.publish(json.dumps({
+                "op": "stats", "origin": "other", "action": "message", "id": message_id + 1,
+                "group": False, "timestamp": "2024-01-01T00:00:01"
+            }) + "\n")
+            assert stats.snapshot()["total_messages"] == 2
+        finally:
+            db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,125 @@
+"""
+MessageExport streams every matching row exactly once, in id order, in each
+format, and its memory use does not grow with the number of rows exported.
+"""
+
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tracemalloc
+import zlib
+
+import pytest
+
+from core_logic.async_database import AsyncDatabase
+from core_logic.export import MessageExport
+
+BATCH_SIZE = 64
+# Quotes, commas, newlines and non-ASCII text, so the encodings are exercised
+TEXTS = ("plain", 'with "quotes", commas', "two\nlines", "emoji 🎉 and ümlauts", "")
+
+
+def _fill(database, start: int, count: int):
+    rows = [
+        (
+            ("alice", "bob", "carol")[i % 3],
+            "GROUP" if i % 2 else "bob",
+            f"{TEXTS[i % len(TEXTS)]} #{i} " + "x" * (i % 200),
+            f"2024-01-{1 + i % 28:02d}T00:00:{i % 60:02d}",
+            i % 7 == 0,
+            f"/uploads/{i}.png" if i % 11 == 0 else None,
+        )
+        for i in range(start, start + count)
+    ]
+    with database._write() as conn:
+        conn.executemany(
+            "INSERT INTO messages (sender, recipient, message, timestamp, edited, file_url)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def _expected(database, where: str = "1", params=()):
+    with database._read() as conn:
+        return conn.execute(
+            f"SELECT {', '.join(database.EXPORT_COLUMNS)} FROM messages WHERE {where} ORDER BY id", params
+        ).fetchall()
+
+
+async def _collect(export: MessageExport) -> bytes:
+    return b"".join([chunk async for chunk in export])
+
+
+def _parse(export: MessageExport, data: bytes):
+    text = data.decode("utf-8")
+    if export.format == "csv":
+        return list(csv.reader(io.StringIO(text, newline="")))
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def _as_exported(export: MessageExport, rows):
+    """Database rows the way the export's format represents them."""
+    if export.format == "csv":
+        return [list(export.columns)] + [["" if v is None else str(v) for v in row] for row in rows]
+    return [dict(zip(export.columns, row)) for row in rows]
+
+
+@pytest.fixture
+def db(database):
+    _fill(database, 0, 3000)
+    db = AsyncDatabase(database)
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+@pytest.mark.parametrize("compress", [False, True])
+def test_export_streams_every_row(db, format, compress):
+    export = MessageExport(db, format=format, compress=compress, batch_size=BATCH_SIZE)
+    data = asyncio.run(_collect(export))
+    if compress:
+        data = gzip.decompress(data)
+
+    assert _parse(export, data) == _as_exported(export, _expected(db.database))
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+def test_export_filters(db, format):
+    export = MessageExport(db, format=format, batch_size=BATCH_SIZE, sender="carol",
+                           recipient="GROUP", since="2024-01-05", until="2024-01-20")
+    expected = _expected(db.database, "sender = ? AND recipient = ? AND timestamp >= ? AND timestamp < ?",
+                         ("carol", "GROUP", "2024-01-05", "2024-01-20"))
+
+    assert expected  # The filters still match something
+    assert _parse(export, asyncio.run(_collect(export))) == _as_exported(export, expected)
+
+
+def test_export_memory_does_not_grow_with_rows(db):
+    async def peak_memory(compress: bool) -> tuple:
+        """Peak traced memory while streaming a whole export, and the bytes it produced."""
+        export = MessageExport(db, format="csv", compress=compress, batch_size=BATCH_SIZE)
+        # Feed the output to a decompressor as it arrives, like a client would, without keeping it
+        reader = zlib.decompressobj(31) if compress else None
+        size = 0
+        tracemalloc.start()
+        try:
+            async for chunk in export:
+                size += len(reader.decompress(chunk) if reader else chunk)
+            return tracemalloc.get_traced_memory()[1], size
+        finally:
+            tracemalloc.stop()
+
+    async def scenario():
+        await _collect(MessageExport(db, batch_size=BATCH_SIZE))  # Warm up the thread pool and connections
+        small = [await peak_memory(compress) for compress in (False, True)]
+        await db.run(_fill, db.database, 3000, 9000)
+        large = [await peak_memory(compress) for compress in (False, True)]
+
+        for (small_peak, small_size), (large_peak, large_size) in zip(small, large):
+            assert large_size > 3 * small_size
+            # About one batch (plus the compressor's fixed state) in flight either way
+            assert large_peak < small_peak * 1.25 + 64 * 1024
+
+    asyncio.run(scenario())
@@ -0,0 +1,154 @@
+"""
+Every page HistoryCache serves must equal what the database returns for the
+same request, through saves, edits, deletes and reactions.
+"""
+
+import asyncio
+import functools
+import random
+
+import pytest
+
+from core_logic.async_database import AsyncDatabase
+from core_logic.brokers import InProcessBroker
+from core_logic.history_cache import HistoryCache, conversation_key
+from core_logic.managers import ConnectionManager
+
+USERS = ("alice", "bob", "carol")
+CAPACITY = 20
+
+
+class Chat:
+    """Writes the way main.py does: database first, then the matching cache update."""
+
+    def __init__(self, db: AsyncDatabase, cache: HistoryCache):
+        self.db = db
+        self.cache = cache
+        self.clock = 0
+
+    async def send(self, sender: str, recipient: str, text: str) -> int:
+        self.clock += 1
+        timestamp = f"2024-01-01T00:{self.clock // 60:02d}:{self.clock % 60:02d}"
+        message_id = await self.db.save_message_with_id(sender, recipient, text, timestamp)
+        await self.cache.message_saved(conversation_key(sender, recipient), {
+            "id": message_id,
+            "sender": sender,
+            "message": text,
+            "timestamp": timestamp,
+            "edited": False,
+            "deleted": False,
+            "reply_to": None,
+            "file_url": None,
+            "file_type": None,
+            "thumbnail_url": None,
+            "placeholder": None,
+            "reactions": []
+        })
+        return message_id
+
+    async def edit(self, message_id, text: str):
+        await self.db.update_message(message_id, text)
+        await self.cache.message_edited(message_id, text)
+
+    async def delete(self, message_id):
+        await self.db.delete_message(message_id)
+        await self.cache.message_deleted(message_id)
+
+    async def react(self, message_id, username: str, emoji: str):
+        await self.db.add_reaction(message_id, username, emoji)
+        await self.cache.reactions_changed(message_id, await self.db.get_message_reactions(message_id))
+
+    def loader(self, viewer: str, recipient: str):
+        if recipient == "GROUP":
+            return self.db.get_group_messages_enhanced
+        return functools.partial(self.db.get_private_messages_enhanced, viewer, recipient)
+
+
+@pytest.fixture
+def chat(database):
+    db = AsyncDatabase(database)
+    for user in USERS:
+        database.create_user(user, "x")
+    manager = ConnectionManager(broker=InProcessBroker())
+    yield Chat(db, HistoryCache(manager, capacity=CAPACITY, max_conversations=1))
+    db.close()
+
+
+async def _assert_consistent(chat: Chat, ids):
+    """Compare cached and database pages for a spread of cursors and limits."""
+    cursors = [None] + random.sample(ids, min(len(ids), 8)) + [ids[0] - 1, ids[-1] + 1]
+    for viewer, recipient in (("alice", "GROUP"), ("alice", "bob"), ("carol", "bob")):
+        key = conversation_key(viewer, recipient)
+        load = chat.loader(viewer, recipient)
+        for limit in (1, 5, CAPACITY, 50):
+            for before_id in cursors:
+                expected = await load(limit, before_id, None)
+                assert await chat.cache.get_page(key, limit, before_id, None, load=load) == expected
+            for after_id in cursors[1:]:
+                expected = await load(limit, None, after_id)
+                assert await chat.cache.get_page(key, limit, None, after_id, load=load) == expected
+
+
+@pytest.mark.parametrize("seed", range(1, 9))
+def test_cache_matches_database(chat, seed):
+    random.seed(seed)
+
+    async def scenario():
+        ids = []
+        pairs = [("alice", "GROUP"), ("bob", "GROUP"), ("alice", "bob"), ("bob", "alice"), ("carol", "bob")]
+        for i in range(60):
+            ids.append(await chat.send(*random.choice(pairs), f"message {i}"))
+        await _assert_consistent(chat, ids)  # Fills the cache
+
+        for i in range(200):
+            action = random.random()
+            if action < 0.4:
+                ids.append(await chat.send(*random.choice(pairs), f"later {i}"))
+            elif action < 0.6:
+                await chat.edit(random.choice(ids), f"edited {i}")
+            elif action < 0.75:
+                await chat.delete(random.choice(ids))
+            else:
+                await chat.react(random.choice(ids), random.choice(USERS), random.choice("👍🎉"))
+            if i % 20 == 0:
+                await _assert_consistent(chat, ids)
+        await _assert_consistent(chat, ids)
+        assert chat.cache.hits > 0
+
+    asyncio.run(scenario())
+
+
+def test_client_cursors_are_normalised(chat):
+    async def scenario():
+        ids = [await chat.send("alice", "GROUP", f"message {i}") for i in range(10)]
+        load = chat.loader("alice", "GROUP")
+        await chat.cache.get_page("GROUP", 5, load=load)  # Fill
+
+        expected = await load(3, ids[5], None)
+        assert await chat.cache.get_page("GROUP", 3, str(ids[5]), None, load=load) == expected
+        expected = await load(3, None, ids[5])
+        assert await chat.cache.get_page("GROUP", 3, None, str(ids[5]), load=load) == expected
+        # Not a message id at all: treated as no cursor instead of raising
+        newest = await load(3, None, None)
+        for bad in ("abc", [1], {"id": 1}):
+            assert await chat.cache.get_page("GROUP", 3, bad, None, load=load) == newest
+            assert await chat.cache.get_page("GROUP", 3, None, bad, load=load) == newest
+
+    asyncio.run(scenario())
+
+
+def test_reactions_keep_database_order(chat):
+    async def scenario():
+        message_id = await chat.send("alice", "GROUP", "hello")
+        load = chat.loader("alice", "GROUP")
+        await chat.cache.get_page("GROUP", 5, load=load)  # Fill
+        # Reacted in the opposite order to the (message_id, username, emoji) index
+        await chat.react(message_id, "bob", "👍")
+        await chat.react(message_id, "alice", "👍")
+
+        reactions = [{"emoji": "👍", "username": "bob"}, {"emoji": "👍", "username": "alice"}]
+        assert await chat.db.get_message_reactions(message_id) == reactions
+        assert (await load(5, None, None))[0]["reactions"] == reactions
+        assert (await chat.cache.get_page("GROUP", 5, load=load))[0]["reactions"] == reactions
+
+    asyncio.run(scenario())
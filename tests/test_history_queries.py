@@ -0,0 +1,57 @@
+"""History pages must cost a fixed number of queries, however many messages they hold."""
+
+import pytest
+
+
+def _seed(db, count):
+    for name in ("alice", "bob"):
+        db.create_user(name, "x")
+    for i in range(count):
+        recipient = "GROUP" if i % 2 else ("bob" if i % 4 else "alice")
+        sender = "alice" if i % 4 else "bob"
+        message_id = db.save_message_with_id(sender, recipient, f"message {i}", f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}")
+        db.add_reaction(message_id, "alice", "👍")
+        db.add_reaction(message_id, "bob", "🎉")
+
+
+def _queries(executed, load):
+    executed.clear()
+    page = load()
+    return page, [sql for sql in executed if not sql.lstrip().upper().startswith("PRAGMA")]
+
+
+@pytest.mark.parametrize("history", ["group", "private"])
+def test_query_count_does_not_grow_with_page_size(statements, history):
+    db, executed = statements
+    _seed(db, 400)
+
+    counts = {}
+    for limit in (1, 10, 100, 200):
+        if history == "group":
+            page, queries = _queries(executed, lambda: db.get_group_messages_enhanced(limit))
+        else:
+            page, queries = _queries(executed, lambda: db.get_private_messages_enhanced("alice", "bob", limit))
+        assert len(page) == limit
+        assert all(len(message["reactions"]) == 2 for message in page)
+        counts[limit] = len(queries)
+
+    # One query for the messages, one for all of their reactions
+    assert set(counts.values()) == {2}, counts
+
+
+def test_cursor_pages_use_the_same_query_count(statements):
+    db, executed = statements
+    _seed(db, 400)
+    newest = db.get_group_messages_enhanced(50)
+
+    _, older = _queries(executed, lambda: db.get_group_messages_enhanced(50, before_id=newest[0]["id"]))
+    _, newer = _queries(executed, lambda: db.get_group_messages_enhanced(50, after_id=newest[0]["id"]))
+    assert len(older) == len(newer) == 2
+
+
+def test_empty_page_skips_the_reaction_query(statements):
+    db, executed = statements
+    _seed(db, 10)
+    page, queries = _queries(executed, lambda: db.get_private_messages_enhanced("alice", "nobody", 50))
+    assert page == []
+    assert len(queries) == 1
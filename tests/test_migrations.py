@@ -0,0 +1,50 @@
+"""
+Processes starting together on a fresh database apply each migration once.
+"""
+
+import multiprocessing
+import sqlite3
+
+from core_logic.database import Database
+
+PROCESSES = 4
+
+
+def _open(path: str, barrier, errors):
+    barrier.wait()
+    try:
+        Database(path).close()
+    except Exception as e:
+        errors.put(repr(e))
+
+
+def test_concurrent_startup_migrates_once(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    for run in range(5):
+        path = str(tmp_path / f"chat{run}.db")
+        # A message before any migration, so the FTS backfill has a row to copy
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT NOT NULL,"
+                         " recipient TEXT NOT NULL, message TEXT NOT NULL, timestamp TEXT NOT NULL,"
+                         " edited INTEGER DEFAULT 0, deleted INTEGER DEFAULT 0, reply_to INTEGER DEFAULT NULL,"
+                         " file_url TEXT DEFAULT NULL, file_type TEXT DEFAULT NULL)")
+            conn.execute("INSERT INTO messages (sender, recipient, message, timestamp)"
+                         " VALUES ('alice', 'GROUP', 'hello', '2024-01-01T00:00:00')")
+
+        barrier = context.Barrier(PROCESSES)
+        errors = context.Queue()
+        workers = [context.Process(target=_open, args=(path, barrier, errors)) for _ in range(PROCESSES)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+        assert [worker.exitcode for worker in workers] == [0] * PROCESSES
+        assert errors.empty(), errors.get()
+
+        db = Database(path)
+        try:
+            with db._read() as conn:
+                assert conn.execute("PRAGMA user_version").fetchone()[0] == len(Database.MIGRATIONS)
+                assert conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'hello'").fetchall() == [(1,)]
+        finally:
+            db.close()
@@ -0,0 +1,147 @@
+"""
+Every Database query must be answered from an index.
+
+Each method is run against a small database while its SQL is traced, and
+every statement (including the ones triggers run) is fed to EXPLAIN QUERY
+PLAN. No query may scan a whole table; hot-path queries, run per message or
+per request, may not even walk a whole index unless they stop at a LIMIT.
+"""
+
+import re
+import sqlite3
+
+import pytest
+
+# Plan rows that read every row of a table: 'SCAN messages', 'SCAN m'
+BARE_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW$)(?!\()(\S+)$")
+# Plan rows that walk a table or one of its indexes from end to end
+ANY_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW$)(?!\()(\S+)")
+
+# Small derived tables and FTS internals that are fine to scan
+SCAN_ALLOWED = {"page", "main.messages_fts_config"}
+
+FILE_URL = "/uploads/ab/cd/abcd.png"
+
+# (name, call, hot): hot queries run per message or per request
+QUERIES = [
+    ("user_exists", lambda db, ids: db.user_exists("alice"), True),
+    ("get_password_hash", lambda db, ids: db.get_password_hash("alice"), True),
+    ("update_password_hash", lambda db, ids: db.update_password_hash("alice", "x", "y"), True),
+    ("get_user_info", lambda db, ids: db.get_user_info("alice"), True),
+    ("update_user_status", lambda db, ids: db.update_user_status("alice", "away"), True),
+    ("add_uploaded_bytes", lambda db, ids: db.add_uploaded_bytes("alice", 10), True),
+    ("save_message_with_id", lambda db, ids: db.save_message_with_id("bob", "GROUP", "new", "2024-01-02T00:00:00"), True),
+    ("group_history", lambda db, ids: db.get_group_messages_enhanced(50), True),
+    ("group_history_before", lambda db, ids: db.get_group_messages_enhanced(50, before_id=ids[-1]), True),
+    ("group_history_after", lambda db, ids: db.get_group_messages_enhanced(50, after_id=ids[0]), True),
+    ("private_history", lambda db, ids: db.get_private_messages_enhanced("alice", "bob", 50), True),
+    ("private_history_before", lambda db, ids: db.get_private_messages_enhanced("alice", "bob", 50, before_id=ids[-1]), True),
+    ("private_history_after", lambda db, ids: db.get_private_messages_enhanced("alice", "bob", 50, after_id=ids[0]), True),
+    ("add_reaction", lambda db, ids: db.add_reaction(ids[0], "bob", "👍"), True),
+    ("get_message_reactions", lambda db, ids: db.get_message_reactions(ids[0]), True),
+    ("update_message", lambda db, ids: db.update_message(ids[0], "edited"), True),
+    ("delete_message", lambda db, ids: db.delete_message(ids[0]), True),
+    ("mark_message_read", lambda db, ids: db.mark_message_read(ids[0], "bob"), True),
+    ("set_file_preview", lambda db, ids: db.set_file_preview(FILE_URL, "/uploads/thumbs/t.webp", "data:"), True),
+    ("search_messages", lambda db, ids: db.search_messages("hello", "alice"), True),
+    ("get_messages_today", lambda db, ids: db.get_messages_today(), True),
+    ("get_group_message_count", lambda db, ids: db.get_group_message_count(), True),
+    ("get_all_messages", lambda db, ids: db.get_all_messages(), True),
+    ("get_group_messages", lambda db, ids: db.get_group_messages(), True),
+    ("get_private_messages", lambda db, ids: db.get_private_messages("alice", "bob"), True),
+    ("get_messages_for_export", lambda db, ids: db.get_messages_for_export(0, 100, "2024", "2025", "alice", "bob"), False),
+    *[
+        (f"users_by_{sort}", lambda db, ids, sort=sort: db.get_all_users_with_stats(sort, True, 50, 10), True)
+        for sort in ("username", "created_at", "message_count", "last_active", "bytes_uploaded")
+    ],
+    # Whole-table by design: counters are seeded once at startup, the user list is cached by clients
+    ("get_message_counts", lambda db, ids: db.get_message_counts(), False),
+    ("get_total_users", lambda db, ids: db.get_total_users(), False),
+    ("get_total_messages", lambda db, ids: db.get_total_messages(), False),
+    ("get_all_users", lambda db, ids: db.get_all_users(), False),
+]
+
+
+@pytest.fixture
+def seeded(statements):
+    db, executed = statements
+    for name in ("alice", "bob"):
+        db.create_user(name, "x")
+    ids = []
+    for i in range(20):
+        recipient = "GROUP" if i % 2 else "bob"
+        file_url = FILE_URL if i == 0 else None
+        ids.append(db.save_message_with_id("alice", recipient, f"hello {i}", f"2024-01-01T00:00:{i:02d}",
+                                           None, file_url, "image" if file_url else None))
+    return db, executed, ids
+
+
+def _statements(executed):
+    for sql in executed:
+        text = sql.strip()
+        if text and not text.upper().startswith(("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "--")):
+            yield text
+
+
+def _plan(conn, sql):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def _violations(conn, executed, hot):
+    found = []
+    for sql in _statements(executed):
+        limited = re.search(r"\bLIMIT\b", sql, re.IGNORECASE) is not None
+        for detail in _plan(conn, sql):
+            bare = BARE_SCAN.match(detail)
+            if bare and bare.group(1) not in SCAN_ALLOWED:
+                found.append((detail, sql))
+                continue
+            scan = ANY_SCAN.match(detail)
+            # An index walked in order and cut off by LIMIT (keyset/offset paging) is fine
+            if hot and scan and scan.group(1) not in SCAN_ALLOWED and not limited:
+                found.append((detail, sql))
+    return found
+
+
+@pytest.mark.parametrize("name, call, hot", QUERIES, ids=[query[0] for query in QUERIES])
+def test_query_does_not_scan_tables(seeded, name, call, hot):
+    db, executed, ids = seeded
+    executed.clear()
+    call(db, ids)
+    assert list(_statements(executed)), f"{name} ran no SQL"
+
+    conn = sqlite3.connect(db.db_path)
+    try:
+        violations = _violations(conn, executed, hot)
+    finally:
+        conn.close()
+    assert not violations, "\n".join(f"{detail}\n    in: {' '.join(sql.split())}" for detail, sql in violations)
+
+
+def test_scan_detection(seeded):
+    """The checks above must actually catch an unindexed query."""
+    db, executed, ids = seeded
+    conn = sqlite3.connect(db.db_path)
+    try:
+        unindexed = ["SELECT * FROM messages WHERE message = 'hello 1'"]
+        assert _violations(conn, unindexed, hot=False)
+        whole_index = ["SELECT COUNT(*) FROM messages"]
+        assert not _violations(conn, whole_index, hot=False)
+        assert _violations(conn, whole_index, hot=True)
+    finally:
+        conn.close()
+
+
+def test_every_query_method_is_checked():
+    """New Database query methods have to be added to QUERIES."""
+    from core_logic.database import Database
+
+    checked = {name for name, _, _ in QUERIES}
+    checked.update({"get_group_messages_enhanced", "get_private_messages_enhanced", "get_all_users_with_stats"})
+    # Not queries: setup, lifecycle and write-only helpers without a WHERE clause
+    unchecked = {"close", "create_user", "save_message"}
+    methods = {
+        name for name, value in vars(Database).items()
+        if callable(value) and not name.startswith("_")
+    }
+    assert methods - checked - unchecked == set()
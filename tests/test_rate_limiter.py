@@ -0,0 +1,73 @@
+"""
+RedisBucketStore runs its Lua script against a Redis stand-in, recovers from
+lost connections and cancelled calls, and fails open while Redis is down.
+"""
+
+import asyncio
+
+import pytest
+
+from core_logic.leaky_bucket import LeakyBucket
+from core_logic.rate_limiter import MemoryBucketStore, RedisBucketStore
+
+BUCKET = LeakyBucket(capacity=3, leak_rate=0.01)
+
+
+async def _burst(store, key: str, count: int):
+    return [(await store.add("upload", key, BUCKET))[0] for _ in range(count)]
+
+
+def test_memory_store_limits():
+    assert asyncio.run(_burst(MemoryBucketStore(), "alice", 5)) == [True, True, True, False, False]
+
+
+def test_redis_store_limits(redis_server):
+    async def scenario():
+        store = RedisBucketStore(redis_server.url)
+        try:
+            assert await _burst(store, "alice", 5) == [True, True, True, False, False]
+            assert await _burst(store, "bob", 1) == [True]
+            allowed, retry_after = await store.add("upload", "alice", BUCKET)
+            assert not allowed and retry_after == pytest.approx(100, rel=0.1)
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_redis_store_survives_restart(redis_server):
+    async def scenario():
+        store = RedisBucketStore(redis_server.url, retry_delay=0.1)
+        try:
+            assert await _burst(store, "alice", 1) == [True]
+            redis_server.stop()
+            # Down: every action is allowed, without a connection attempt per call
+            assert await _burst(store, "alice", 5) == [True] * 5
+
+            redis_server.start()  # Comes back empty
+            await asyncio.sleep(0.15)
+            assert await _burst(store, "alice", 4) == [True, True, True, False]
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_redis_store_resets_after_cancellation(redis_server):
+    async def scenario():
+        store = RedisBucketStore(redis_server.url)
+        try:
+            await store.add("upload", "alice", BUCKET)
+            task = asyncio.create_task(store.add("upload", "alice", BUCKET))
+            await asyncio.sleep(0)  # Request written, reply not read yet
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # The unread reply must not be taken as the answer to the next call
+            allowed, retry_after = await store.add("upload", "bob", BUCKET)
+            assert allowed and retry_after == 0
+            assert await _burst(store, "bob", 3) == [True, True, False]
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+"""
+Multipart uploads are parsed and written while they are received: one copy
+on disk, and an oversized body is abandoned as soon as it passes the limit.
+"""
+
+import asyncio
+import hashlib
+
+import pytest
+
+from core_logic.uploads import InvalidUpload, UploadStore, UploadTooLarge
+
+BOUNDARY = "----mkchat-test"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def _form(content: bytes, filename: str = "notes.txt", fields: dict = None) -> bytes:
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: text/plain\r\n\r\n".encode() + content + b"\r\n"
+    )
+    parts.append(f"--{BOUNDARY}--\r\n".encode())
+    return b"".join(parts)
+
+
+class Body:
+    """An async request body delivered in small reads, counting what was consumed."""
+
+    def __init__(self, data: bytes, chunk: int = 7):
+        self.data = data
+        self.chunk = chunk
+        self.consumed = 0
+
+    async def __aiter__(self):
+        while self.consumed < len(self.data):
+            piece = self.data[self.consumed:self.consumed + self.chunk]
+            self.consumed += len(piece)
+            yield piece
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UploadStore(str(tmp_path / "uploads"), max_size=1000, chunk_size=64)
+    yield store
+    store.close()
+
+
+def _files(store):
+    return sorted(p.relative_to(store.directory).as_posix() for p in store.directory.rglob("*") if p.is_file())
+
+
+def test_receive_writes_file_and_fields(store):
+    content = bytes(range(256)) * 3
+    received = asyncio.run(store.receive(Body(_form(content, fields={"username": "alice"})), CONTENT_TYPE))
+
+    sha256 = hashlib.sha256(content).hexdigest()
+    assert received.stored.sha256 == sha256
+    assert received.stored.size == len(content)
+    assert received.stored.path.read_bytes() == content
+    assert received.filename == "notes.txt"
+    assert received.content_type == "text/plain"
+    assert received.fields == {"username": "alice"}
+    # Only the stored copy (and its gzip variant), no leftover partials or temp copies
+    assert [f for f in _files(store) if not f.endswith(".gz")] == [received.stored.filename]
+
+
+def test_receive_stops_reading_past_the_limit(store):
+    body = Body(_form(b"x" * 50_000), chunk=100)
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(store.receive(body, CONTENT_TYPE))
+    assert body.consumed < 2000
+    store.close()  # Let the abort run
+    assert _files(store) == []
+
+
+@pytest.mark.parametrize("content_type, body", [
+    ("application/json", b"{}"),
+    ("multipart/form-data", b""),  # No boundary
+    (CONTENT_TYPE, _form(b"").replace(b'; filename="notes.txt"', b"")),  # No file part
+    (CONTENT_TYPE, b"garbage" * 10),
+])
+def test_receive_rejects_invalid_forms(store, content_type, body):
+    with pytest.raises(InvalidUpload):
+        asyncio.run(store.receive(Body(body), content_type))
+    store.close()
+    assert _files(store) == []
+
+
+def test_receive_rejects_long_fields(store):
+    with pytest.raises(InvalidUpload):
+        asyncio.run(store.receive(Body(_form(b"data", fields={"username": "a" * 2000})), CONTENT_TYPE))